@@ -7,6 +7,8 @@ class AHT10:
     CMD_MEASURE = bytearray([0xAC, 0x33, 0x00]) # Docs claim 0x33 is related to ADC
     STATUS_BUSY = 0x80  # Status bit for busy
     STATUS_CALIBRATED = 0x08  # Status bit for calibrated
+    CONVERSION_MS = 75 # Typical time for a measurement
+    POLL_MS = 5 # Interval between busy checks while waiting on a measurement
     
     def __init__(self, i2c, address=0x38, offset=0): #or 0x39 with a resistor mod
         self.i2c = i2c
@@ -23,14 +25,32 @@ class AHT10:
     def _status(self):
         self.raw_status = self.i2c.readfrom(self.address, 1)
     
-    def _measure(self):
+    def trigger(self):
+        '''
+        Start a measurement without waiting for it. When several mux channels
+        are enabled at once this starts every AHT10 on them simultaneously.
+        '''
         self.i2c.writeto(self.address, AHT10.CMD_MEASURE)
-        time.sleep_ms(75)
-        self.i2c.readfrom_into(self.address, self.data) # Might be better to loop than wait and hope
-        assert (self.data[0] & AHT10.STATUS_BUSY) == 0, 'Device was busy'
+    
+    def collect(self, timeout_ms=3*CONVERSION_MS):
+        '''
+        Read back a measurement started by trigger(), polling the busy bit
+        until the result is ready.
+        '''
+        start = time.ticks_ms()
+        while True:
+            self.i2c.readfrom_into(self.address, self.data)
+            if (self.data[0] & AHT10.STATUS_BUSY) == 0:
+                break
+            assert time.ticks_diff(time.ticks_ms(), start) < timeout_ms, 'Device was busy'
+            time.sleep_ms(AHT10.POLL_MS)
         assert (self.data[0] & AHT10.STATUS_CALIBRATED) != 0, 'Device not calibrated'
         self.raw_humid = self.data[1] << 12 | self.data[2] << 4 | self.data[3] >> 4
         self.raw_temp = (self.data[3] & 0x0F) << 16 | self.data[4] << 8 | self.data[5]
+    
+    def _measure(self):
+        self.trigger()
+        self.collect()
         
     def both(self, read=True):
         if read: self._measure()
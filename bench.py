@@ -0,0 +1,609 @@
+'''
+Host-side benchmarks for the BeeLogger firmware, run with CPython against the
+simulated board in sim.py:
+    python3 bench.py [--only SECTION,...] [--requests N] [--clients N] [--reads N]
+                     [--json FILE] [--baseline FILE] [--tolerance FRACTION]
+
+Sections are reply, server, sensors, muxes, i2c, compensation, endpoints,
+display and boot. --json writes the
+results for use as a later --baseline; with --baseline every metric is
+compared and the exit status is 1 if any got worse by more than the
+tolerance (default 0.2).
+'''
+import asyncio
+import contextlib
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import sim
+from server import JSONServer
+
+def start_server(server, blocking=False):
+    '''
+    Run server.serve() or server.serve_async() (on its own event loop) in a
+    daemon thread.
+    '''
+    if blocking:
+        threading.Thread(target=server.serve, daemon=True).start()
+    else:
+        threading.Thread(target=lambda: asyncio.run(server.serve_async()), daemon=True).start()
+    for _ in range(100):
+        try:
+            get(server.port, '/hello')
+            return
+        except OSError:
+            time.sleep(0.01)
+    raise RuntimeError('server did not start')
+
+class Client:
+    '''
+    Minimal blocking HTTP/1.1 client, optionally reusing its connection.
+    '''
+    
+    def __init__(self, port, keep_alive=False):
+        self.port = port
+        self.keep_alive = keep_alive
+        self.sock = None
+        self.buf = b''
+        
+    def _recv(self):
+        data = self.sock.recv(4096)
+        if not data:
+            raise EOFError('server closed the connection')
+        self.buf += data
+        
+    def _take(self, n):
+        while len(self.buf) < n:
+            self._recv()
+        data, self.buf = self.buf[:n], self.buf[n:]
+        return data
+        
+    def _line(self):
+        while b'\r\n' not in self.buf:
+            self._recv()
+        line, self.buf = self.buf.split(b'\r\n', 1)
+        return line
+        
+    def get(self, target):
+        '''
+        Returns (status code, body) of a GET request.
+        '''
+        if self.sock is None:
+            self.sock = socket.create_connection(('127.0.0.1', self.port))
+            self.buf = b''
+        connection = 'keep-alive' if self.keep_alive else 'close'
+        self.sock.sendall(f'GET {target} HTTP/1.1\r\nHost: bench\r\nConnection: {connection}\r\n\r\n'.encode('utf-8'))
+        code = int(self._line().split(b' ')[1])
+        headers = {}
+        while line := self._line():
+            key,value = line.decode('utf-8').split(':', 1)
+            headers[key.lower()] = value.strip().lower()
+        if headers.get('transfer-encoding') == 'chunked':
+            body = b''
+            while size := int(self._line(), 16):
+                body += self._take(size)
+                self._line()
+            self._line()
+        else:
+            body = self._take(int(headers['content-length']))
+        if headers.get('connection') != 'keep-alive':
+            self.close()
+        return code, body
+        
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+def get(port, target):
+    '''
+    One HTTP request on a fresh connection, returns (status code, body).
+    '''
+    return Client(port).get(target)
+
+def load(port, target, requests=2000, clients=8, keep_alive=False):
+    '''
+    Issue requests from several concurrent clients.
+    Returns requests/sec and the p50/p99 latency in ms.
+    '''
+    latencies = []
+    def client(n):
+        conn = Client(port, keep_alive)
+        for _ in range(n):
+            t = time.perf_counter()
+            code,_ = conn.get(target)
+            assert code == 200, f'bad response {code}'
+            latencies.append((time.perf_counter() - t) * 1000)
+        conn.close()
+    threads = [threading.Thread(target=client, args=(requests // clients,)) for _ in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'rps': len(latencies) / elapsed,
+        'p50_ms': latencies[len(latencies) // 2],
+        'p99_ms': latencies[int(len(latencies) * 0.99)],
+    }
+
+class CountingConn:
+    '''
+    Stands in for a client socket, counting the writes a reply makes.
+    '''
+    
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+        
+    def send(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+        
+    def sendall(self, data):
+        self.send(data)
+        
+    def close(self):
+        pass
+
+def bench_reply(replies=20000):
+    '''
+    Cost of JSONServer._reply() alone, and the socket writes (so TCP segments
+    on lwIP without Nagle coalescing) it takes per response.
+    '''
+    server = JSONServer(verbose=False)
+    conn = CountingConn()
+    start = time.perf_counter()
+    for _ in range(replies):
+        server._reply(conn, msg='greetings')
+    elapsed = time.perf_counter() - start
+    return {'_reply': {
+        'replies_per_s': replies / elapsed,
+        'us_per_reply': elapsed / replies * 1e6,
+        'writes_per_reply': conn.writes / replies,
+        'bytes_per_reply': conn.bytes / replies,
+    }}
+
+def bench_server(requests=2000, clients=8, port=8181):
+    '''
+    Requests/sec and latency of /hello in both serving modes. The listen
+    backlog is the number of clients, see bench_endpoints().
+    '''
+    results = {}
+    for mode,blocking in (('serve', True), ('serve_async', False)):
+        server = JSONServer(addr='127.0.0.1', port=port, backlog=clients, verbose=False)
+        start_server(server, blocking)
+        results[f'{mode} GET /hello'] = load(port, '/hello', requests, clients)
+        results[f'{mode} GET /hello keep-alive'] = load(port, '/hello', requests, clients, keep_alive=True)
+        port += 1
+    return results
+
+def firmware():
+    '''
+    main.py imported (set up but not serving) on the simulated board, in a
+    scratch directory standing in for the flash filesystem.
+    '''
+    if 'main' not in sys.modules:
+        sim.install()
+        os.chdir(tempfile.mkdtemp(prefix='beelogger-flash-'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            import main
+        main.server.verbose = False
+    return sys.modules['main']
+
+def timed(f, repeats):
+    '''
+    Call f repeats times, returns the mean, min and max latency in ms.
+    '''
+    times = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        f()
+        times.append((time.perf_counter() - t) * 1000)
+    return {
+        'mean_ms': sum(times) / len(times),
+        'min_ms': min(times),
+        'max_ms': max(times),
+    }
+
+def bench_sensors(reads=5):
+    '''
+    Latency of each sensor read path and of a full report(), with the I2C
+    transactions, mux channel switches and modelled bus time each one costs,
+    and how fast sensors come back after a fault.
+    '''
+    sensors = firmware().sensors
+    bus = sim.BOARD.i2c
+    sensors.report() # first conversions, as the sampler does after boot
+    cases = (
+        ('read_lux', sensors.read_lux),
+        ('read_temp_pressure', sensors.read_temp_pressure),
+        ('bmp180 config', sensors.bmp.config),
+        ('read_temp_humid(0)', lambda: sensors.read_temp_humid(0)),
+        ('read_all_temp_humid serial', lambda: sensors.read_all_temp_humid(pipelined=False)),
+        ('read_all_temp_humid', sensors.read_all_temp_humid),
+        ('read_weight', sensors.read_weight),
+        ('report', sensors.report),
+    )
+    results = {}
+    for name,f in cases:
+        bus.reset_counters()
+        result = timed(f, reads)
+        result['i2c_transactions'] = bus.transactions / reads
+        result['mux_writes'] = sum(bus.by_address.get(mux.address, 0) for mux in sim.BOARD.muxes) / reads
+        result['i2c_busy_ms'] = bus.busy_us / reads / 1000
+        results[name] = result
+    # an AHT10 that never finishes converting: the reports it costs until
+    # its breaker trips, then reports once it is down
+    dead = sim.BOARD.ahts[1]
+    dead.fault = 'stuck'
+    try:
+        results['report, aht10 stuck'] = timed(sensors.report, sensors.health.threshold)
+        bus.reset_counters()
+        result = timed(sensors.report, reads)
+        result['i2c_transactions'] = bus.transactions / reads
+        result['mux_writes'] = sum(bus.by_address.get(mux.address, 0) for mux in sim.BOARD.muxes) / reads
+        result['i2c_busy_ms'] = bus.busy_us / reads / 1000
+        results['report, aht10 down'] = result
+    finally:
+        dead.fault = None
+        sensors.health.succeeded(sensors._aht_health[1])
+    # sensors that stop answering and come back, see recovery()
+    results['sample, bmp180 recovers'] = recovery(sensors, 'barometer', sensors._BMP,
+                                                  sim.BOARD.bmp, 'ext_pressure', 'pressure', scale=0.001)
+    results['sample, veml7700 recovers'] = recovery(sensors, 'lux', sensors._VEML,
+                                                    sim.BOARD.veml, 'ambient_lux', 'lux')
+    results['sample, aht10 stuck recovers'] = recovery(sensors, 'temp_humid', sensors._aht_health[1],
+                                                       sim.BOARD.ahts[1], 'temperature_1', 'temperature', fault='stuck')
+    return results
+
+def recovery(sensors, task, slot, model, key, attr, scale=1.0, fault='nack', timeout=5):
+    '''
+    Run only the sampling task named task, with a short period and backoff,
+    while model has fault until its breaker has it down, then clear the fault
+    and move the reading down by a fifth, which keeps a BMP180 in range.
+    Returns the ms and I2C transactions until the new value is stored.
+    A 'stuck' sensor still takes the re-init of every retry, so it is
+    first left failing until its backoff has doubled twice (backoff_ms).
+    '''
+    health = sensors.health
+    tasks, backoff_ms = sensors.tasks, health.backoff_ms
+    sensors.tasks = [[20, time.ticks_ms(), t[2], t[3]] for t in tasks if t[3] == task]
+    health.backoff_ms = 50
+    value = getattr(model, attr)
+    bus = sim.BOARD.i2c
+    try:
+        model.fault = fault
+        deadline = time.monotonic() + timeout
+        while not health.down(slot):
+            assert time.monotonic() < deadline, f'{task} never went down'
+            if not sensors.sample():
+                time.sleep(0.001)
+        result = {}
+        if fault == 'stuck':
+            while health.backoff[slot] < 4 * health.backoff_ms:
+                assert time.monotonic() < deadline, f'{task} backoff stayed at {health.backoff[slot]} ms'
+                if not sensors.sample():
+                    time.sleep(0.001)
+            result['backoff_ms'] = health.backoff[slot]
+        setattr(model, attr, value * 0.8)
+        model.fault = None
+        bus.reset_counters()
+        start = time.ticks_ms()
+        t = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        while health.down(slot) or time.ticks_diff(sensors.stamps.get(key, start - 1), start) < 0:
+            assert time.monotonic() < deadline, f'{task} did not recover'
+            if not sensors.sample():
+                time.sleep(0.001)
+        elapsed = (time.perf_counter() - t) * 1000
+        stored = sensors.snapshot[key]
+        assert abs(stored / (value * 0.8 * scale) - 1) < 0.05, f'{task} stored a stale {key} {stored}'
+        result['recovery_ms'] = elapsed
+        result['i2c_transactions'] = bus.transactions
+        return result
+    finally:
+        model.fault = None
+        setattr(model, attr, value)
+        sensors.tasks = tasks
+        health.backoff_ms = backoff_ms
+
+def bench_muxes(reads=3, counts=(5, 16, 32, 56)):
+    '''
+    Discovery and read cost for growing numbers of AHT10s spread over as
+    many muxes as hold them, each on a fresh simulated board.
+    '''
+    firmware()
+    from machine import Pin, SoftI2C
+    from sensors import Sensors
+    board = sim.BOARD
+    results = {}
+    try:
+        for count in counts:
+            sim.install(sim.Board.default(aht10=count))
+            bus = sim.BOARD.i2c
+            t = time.perf_counter()
+            sensors = Sensors(SoftI2C(scl=Pin(16), sda=Pin(13), freq=100000), None, aht10=None, muxes=None)
+            discovery_ms = (time.perf_counter() - t) * 1000
+            assert len(sensors.ahts) == count, sensors.init_issues
+            bus.reset_counters()
+            result = timed(sensors.read_all_temp_humid, reads)
+            result['discovery_ms'] = discovery_ms
+            result['i2c_transactions'] = bus.transactions / reads
+            result['mux_writes'] = sum(bus.by_address.get(mux.address, 0) for mux in sim.BOARD.muxes) / reads
+            results[f'read_all_temp_humid x{count}'] = result
+    finally:
+        sim.install(board)
+    return results
+
+def bench_i2c(repeats=10):
+    '''
+    Modelled bus time per call of each driver method with SoftI2C and the
+    hardware I2C, at standard (100 kHz) and fast mode (400 kHz), each on a
+    fresh simulated board.
+    '''
+    firmware()
+    from machine import Pin, SoftI2C, I2C
+    from sensors import Sensors
+    board = sim.BOARD
+    buses = (
+        ('SoftI2C 100k', lambda: SoftI2C(scl=Pin(16), sda=Pin(13), freq=100000)),
+        ('SoftI2C 400k', lambda: SoftI2C(scl=Pin(16), sda=Pin(13), freq=400000)),
+        ('I2C 100k', lambda: I2C(1, scl=Pin(16), sda=Pin(13), freq=100000)), # 0 is main.py's
+        ('I2C 400k', lambda: I2C(1, scl=Pin(16), sda=Pin(13), freq=400000)),
+    )
+    results = {}
+    try:
+        for bus_name,make in buses:
+            sim.install(sim.Board.default())
+            sensors = Sensors(make(), None, bmp180=True, veml7700=True, aht10=5)
+            assert not sensors.init_issues, sensors.init_issues
+            aht, bmp, veml = sensors.ahts[0], sensors.bmp, sensors.veml
+            mux = sensors.bus.muxes[0]
+            sensors.bus.select(sensors.aht_channels[0])
+            aht.trigger()
+            aht.collect() # leaves a finished conversion to read back
+            cases = (
+                ('i2cmux.set_state', lambda: mux.set_state(mask=1)),
+                ('aht10.trigger', aht.trigger),
+                ('aht10.collect', aht.collect),
+                ('bmp180.config', bmp.config),
+                ('bmp180.measure', bmp.measure),
+                ('veml7700.lux', veml.lux),
+                ('sensors.report', sensors.report),
+            )
+            for name,f in cases:
+                if name == 'aht10.collect':
+                    time.sleep(0.1) # the triggers above have finished converting
+                sim.BOARD.i2c.reset_counters()
+                timed(f, repeats)
+                bus = sim.BOARD.i2c
+                results[f'{name} {bus_name}'] = {
+                    'bus_us': bus.busy_us / repeats,
+                    'i2c_transactions': bus.transactions / repeats,
+                }
+    finally:
+        sim.install(board)
+    return results
+
+def bench_compensation(points=100):
+    '''
+    The BMP180 float and integer compensation paths on raw values measured
+    over a sweep of simulated conditions: time per temperature + pressure
+    conversion and the largest error against the simulated truth.
+    '''
+    bmp = firmware().sensors.bmp
+    model = sim.BOARD.bmp
+    integer = bmp.integer
+    temperature, pressure = model.temperature, model.pressure
+    raws = []
+    bmp.measure() # finish any pair the sampler left in flight
+    for i in range(points):
+        model.temperature = -20.0 + 70.0 * i / points
+        model.pressure = 80000.0 + 30000.0 * ((i * 37) % points) / points
+        bmp.measure()
+        raws.append((bmp.UT_raw, bmp.UP_raw, model.temperature, model.pressure))
+    model.temperature, model.pressure = temperature, pressure
+    results = {}
+    for name,mode in (('float', False), ('integer', True)):
+        bmp.integer = mode
+        temp_error = pressure_error = 0.0
+        elapsed = 0.0
+        for ut,up,true_temp,true_pressure in raws:
+            bmp.UT_raw, bmp.UP_raw = ut, up
+            t = time.perf_counter()
+            temp = bmp.temperature(read=False)
+            p = bmp.pressure(read=False)
+            elapsed += time.perf_counter() - t
+            temp_error = max(temp_error, abs(temp - true_temp))
+            pressure_error = max(pressure_error, abs(p - true_pressure))
+        results[name] = {
+            'us_per_call': elapsed / points * 1e6,
+            'max_temp_error_c': temp_error,
+            'max_pressure_error_pa': pressure_error,
+        }
+    bmp.integer = integer
+    return results
+
+# query strings for endpoints that need one
+TARGETS = {
+    '/read': '/read?fields=lux,ext_pressure,temperature_0',
+    '/history': '/history?channel=ambient_lux',
+}
+
+def bench_endpoints(requests=500, clients=8, port=8281):
+    '''
+    Requests/sec and latency of every GET endpoint main.py registers, served
+    by its own server under concurrent load. Background sampling only fills
+    the snapshot first (so /read answers from it, as it does once booted)
+    and is not run during the load, so the numbers are the cost of serving
+    alone. The listen backlog is raised to the number of clients, as dropped
+    SYNs otherwise add 1 s retransmits.
+    '''
+    main = firmware()
+    sensors = main.sensors
+    deadline = time.monotonic() + 5
+    while None in sensors.snapshot.values() and time.monotonic() < deadline:
+        if not sensors.sample():
+            time.sleep(0.005)
+    main.server.addr = '127.0.0.1'
+    main.server.port = port
+    main.server.backlog = max(main.server.backlog, clients)
+    start_server(main.server, blocking=not main.ASYNC_SERVER)
+    results = {}
+    for endpoint in main.server._endpoints['GET']:
+        target = TARGETS.get(endpoint, endpoint)
+        results[f'GET {target}'] = load(port, target, requests, clients, keep_alive=True)
+    return results
+
+def bench_display(repeats=3, baudrate=200000):
+    '''
+    Pixels/sec of the ILI9341 drawing primitives on the SPI bus main.py uses,
+    with the SPI writes each call takes.
+    '''
+    firmware()
+    from machine import Pin, SoftSPI
+    from ili9341 import ILI9341, color565
+    spi = SoftSPI(baudrate=baudrate, sck=Pin(14), mosi=Pin(2), miso=Pin(15))
+    tft = ILI9341(spi, cs=Pin(32), dc=Pin(33), rst=None, rotation=90, width=320, height=240)
+    white = color565(255, 255, 255)
+    text = 'ext_temperature = 21.5 C'
+    cases = (
+        ('draw_text', len(text) * 64, lambda: tft.draw_text(8, 8, text, white)),
+        ('draw_text background', len(text) * 64, lambda: tft.draw_text(8, 8, text, white, background=0x1234)),
+        ('draw_pixel', 1, lambda: tft.draw_pixel(10, 10, white)),
+        ('draw_hline', 320, lambda: tft.draw_hline(0, 10, 320, white)),
+        ('draw_rectangle', 2 * (100 + 100), lambda: tft.draw_rectangle(10, 10, 100, 100, white)),
+        ('fill_rectangle', 100 * 100, lambda: tft.fill_rectangle(10, 10, 100, 100, white)),
+        ('clear', 320 * 240, tft.clear),
+    )
+    results = {}
+    for name,pixels,f in cases:
+        writes = sim.BOARD.spi_writes
+        result = timed(f, repeats)
+        result['pixels_per_s'] = pixels / result['mean_ms'] * 1000
+        result['spi_writes'] = (sim.BOARD.spi_writes - writes) / repeats
+        results[name] = result
+    return results
+
+def bench_boot(port=80):
+    '''
+    Boot of sim.py running main.py on an empty flash, then again with what
+    the first boot left there: ms from reset until Sensors is set up, the
+    server listens and the first request (polled for) is answered, as the
+    firmware reports them at /init_log.
+    '''
+    flash = tempfile.mkdtemp(prefix='beelogger-boot-')
+    results = {}
+    for name in ('empty flash', 'cached'):
+        proc = subprocess.Popen([sys.executable, os.path.abspath(sim.__file__), '--flash', flash],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            while True:
+                try:
+                    code,body = get(port, '/init_log')
+                    break
+                except OSError:
+                    assert proc.poll() is None, 'the firmware exited'
+                    time.sleep(0.002)
+        finally:
+            proc.terminate()
+            proc.wait()
+        boot = json.loads(body)['boot']
+        results[name] = {
+            'sensors_ready_ms': boot['sensors_ready'],
+            'listening_ms': boot['listening'],
+            'first_response_ms': boot['first_response'],
+        }
+    return results
+
+def higher_is_better(metric):
+    return metric == 'rps' or metric.endswith('per_s')
+
+def compare(results, baseline, tolerance=0.2):
+    '''
+    Print every metric against the baseline. Returns the names of those
+    that got worse by more than tolerance (a fraction of the baseline).
+    '''
+    regressions = []
+    for section,cases in results.items():
+        for case,metrics in cases.items():
+            old = baseline.get(section, {}).get(case)
+            if old is None:
+                continue
+            for metric,value in metrics.items():
+                if metric not in old:
+                    continue
+                before = old[metric]
+                change = (value - before) / before if before else 0.0
+                worse = -change if higher_is_better(metric) else change
+                flag = ''
+                if worse > tolerance:
+                    flag = '  REGRESSION'
+                    regressions.append(f'{section} / {case} / {metric}')
+                print(f'{section} / {case} / {metric}: {before:.4g} -> {value:.4g} ({change:+.1%}){flag}')
+    return regressions
+
+def print_results(results):
+    for section,cases in results.items():
+        for case,metrics in cases.items():
+            values = ', '.join(f'{metric} {value:.4g}' for metric,value in metrics.items())
+            print(f'{section} / {case}: {values}')
+
+SECTIONS = ('reply', 'server', 'sensors', 'muxes', 'i2c', 'compensation', 'endpoints', 'display', 'boot')
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    def option(name, default):
+        return args[args.index(name) + 1] if name in args else default
+    requests = int(option('--requests', 2000))
+    clients = int(option('--clients', 8))
+    reads = int(option('--reads', 5))
+    only = option('--only', ','.join(SECTIONS)).split(',')
+    output = option('--json', None)
+    baseline = option('--baseline', None)
+    tolerance = float(option('--tolerance', 0.2))
+    # firmware() changes directory to the simulated flash
+    output = output and os.path.abspath(output)
+    baseline = baseline and os.path.abspath(baseline)
+    
+    results = {}
+    if 'reply' in only:
+        results['reply'] = bench_reply()
+    if 'server' in only:
+        results['server'] = bench_server(requests, clients)
+    if 'sensors' in only:
+        results['sensors'] = bench_sensors(reads)
+    if 'muxes' in only:
+        results['muxes'] = bench_muxes()
+    if 'i2c' in only:
+        results['i2c'] = bench_i2c()
+    if 'compensation' in only:
+        results['compensation'] = bench_compensation()
+    if 'endpoints' in only:
+        results['endpoints'] = bench_endpoints(requests // 4, clients)
+    if 'display' in only:
+        results['display'] = bench_display()
+    if 'boot' in only:
+        results['boot'] = bench_boot()
+    print_results(results)
+    
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if baseline is not None:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), tolerance)
+        if len(regressions) > 0:
+            print(f'{len(regressions)} regressions beyond {tolerance:.0%}:')
+            print('\n'.join(regressions))
+            sys.exit(1)
@@ -3,12 +3,27 @@ from machine import I2C, Pin
 import math
 import time
 
+def _div(a, b):
+    '''
+    Integer division truncating toward zero like C, as the datasheet assumes.
+    '''
+    if (a < 0) != (b < 0):
+        return -(-a // b) if a < 0 else -(a // -b)
+    return a // b
+
 class BMP180():
+    # 0x7FFFFFFF // (50000 >> oss): largest B7 / (50000 >> oss) below 2**31, inclusive
+    _B7_LIMIT = (42949, 85899, 171798, 343597)
     
-    def __init__(self, i2c, address=0x77):
-
+    def __init__(self, i2c, address=0x77, integer=False):
+        '''
+            integer - compensate with the datasheet's integer algorithm instead
+                of floats; temperature() is then in 0.1 C steps and pressure()
+                an int in Pa, and no intermediate floats are allocated
+        '''
         self.address = address
         self.i2c = i2c
+        self.integer = integer
         
         self.oversample_setting = 3 # 0,1,2,3
         self.baseline = 101325.0 # pressure at altitude of zero
@@ -16,32 +31,32 @@ class BMP180():
         # output raw
         self.UT_raw = None
         self.B5_raw = None
-        self.MSB_raw = None
-        self.LSB_raw = None
-        self.XLSB_raw = None
+        self.UP_raw = None
+        self._buf = bytearray(3) # result registers 0xF6-0xF8
+        self.ready = False # the raw values hold a complete temperature/pressure pair
+        self.stamp = None # ticks_ms when that pair completed
         self._measure_iter = self._measure()
+        self._due = time.ticks_ms() # when the measurement may be stepped again
         
             
-    def config(self):
+    def config(self, calibration=None, measure=True):
+        '''
+        Check the chip id and read the calibration EEPROM, or take
+        calibration as saved from calibration() when the id is a BMP180's.
+        A first pair is measured unless measure is False (then step() or a
+        read with read=True must run before latest() has one).
+        '''
         self.chip_id = self.i2c.readfrom_mem(self.address, 0xD0, 2)
-        # read calibration data from EEPROM
-        self._AC1 = unp('>h', self.i2c.readfrom_mem(self.address, 0xAA, 2))[0]
-        self._AC2 = unp('>h', self.i2c.readfrom_mem(self.address, 0xAC, 2))[0]
-        self._AC3 = unp('>h', self.i2c.readfrom_mem(self.address, 0xAE, 2))[0]
-        self._AC4 = unp('>H', self.i2c.readfrom_mem(self.address, 0xB0, 2))[0]
-        self._AC5 = unp('>H', self.i2c.readfrom_mem(self.address, 0xB2, 2))[0]
-        self._AC6 = unp('>H', self.i2c.readfrom_mem(self.address, 0xB4, 2))[0]
-        self._B1 = unp('>h', self.i2c.readfrom_mem(self.address, 0xB6, 2))[0]
-        self._B2 = unp('>h', self.i2c.readfrom_mem(self.address, 0xB8, 2))[0]
-        self._MB = unp('>h', self.i2c.readfrom_mem(self.address, 0xBA, 2))[0]
-        self._MC = unp('>h', self.i2c.readfrom_mem(self.address, 0xBC, 2))[0]
-        self._MD = unp('>h', self.i2c.readfrom_mem(self.address, 0xBE, 2))[0]
-        
-        for _ in range(128):
-            next(self._measure_iter)
-            time.sleep_ms(1)
+        if calibration is not None and self.chip_id[0] == 0x55:
+            (self._AC1, self._AC2, self._AC3, self._AC4, self._AC5, self._AC6,
+             self._B1, self._B2, self._MB, self._MC, self._MD, self.oversample_setting) = calibration
+        else:
+            # read the calibration EEPROM (0xAA-0xBF) in one transaction
+            (self._AC1, self._AC2, self._AC3, self._AC4, self._AC5, self._AC6,
+             self._B1, self._B2, self._MB, self._MC, self._MD) = unp('>hhhHHHhhhhh', self.i2c.readfrom_mem(self.address, 0xAA, 22))
         
-    
+        if measure:
+            self.measure()
     
     def calibration(self):
         '''
@@ -52,40 +67,85 @@ class BMP180():
 
     def _measure(self):
         '''
-        Generator refreshing the raw measurments.
+        Generator refreshing the raw measurements. Yields the ms to wait
+        for a conversion, or None once a complete pair has been stored.
         '''
-        delays = (5, 8, 14, 25)
+        delays = (5, 8, 14, 26)
+        buf = self._buf
+        temp_cmd = bytearray([0x2E])
+        pressure_cmd = bytearray(1)
+        ut = memoryview(buf)[:2]
         while True:
-            self.i2c.writeto_mem(self.address, 0xF4, bytearray([0x2E]))
-            t_start = time.ticks_ms()
-            while (time.ticks_ms() - t_start) <= 5: # 5mS delay
-                yield None
-            try:
-                self.UT_raw = self.i2c.readfrom_mem(self.address, 0xF6, 2)
-            except:
-                yield None
-            self.i2c.writeto_mem(self.address, 0xF4, bytearray([0x34+(self.oversample_setting << 6)]))
-            t_pressure_ready = delays[self.oversample_setting]
-            t_start = time.ticks_ms()
-            while (time.ticks_ms() - t_start) <= t_pressure_ready:
-                yield None
-            try:
-                self.MSB_raw = self.i2c.readfrom_mem(self.address, 0xF6, 1)
-                self.LSB_raw = self.i2c.readfrom_mem(self.address, 0xF7, 1)
-                self.XLSB_raw = self.i2c.readfrom_mem(self.address, 0xF8, 1)
-            except:
-                yield None
-            yield True
-            
-    def temperature(self, read=True):
+            self.i2c.writeto_mem(self.address, 0xF4, temp_cmd)
+            yield 5
+            self.i2c.readfrom_mem_into(self.address, 0xF6, ut)
+            UT = (buf[0] << 8) | buf[1]
+            oss = self.oversample_setting
+            pressure_cmd[0] = 0x34+(oss << 6)
+            self.i2c.writeto_mem(self.address, 0xF4, pressure_cmd)
+            yield delays[oss]
+            self.i2c.readfrom_mem_into(self.address, 0xF6, buf) # MSB, LSB, XLSB
+            # only publish whole pairs
+            self.UT_raw = UT
+            self.UP_raw = ((buf[0] << 16) | (buf[1] << 8) | buf[2]) >> (8-oss)
+            self.stamp = time.ticks_ms()
+            self.ready = True
+            yield None
+    
+    def step(self):
         '''
-        Temperature in degree C.
+        Cooperative measurement task: does the next bit of I2C work if its
+        conversion time has passed, and returns the ms until it should be
+        called again, or None when a new pair has just completed. A failed
+        transaction raises and the next step starts a fresh measurement.
         '''
-        if read: next(self._measure_iter)
+        wait = time.ticks_diff(self._due, time.ticks_ms())
+        if wait > 0:
+            return wait
         try:
-            UT = unp('>H', self.UT_raw)[0]
+            wait = next(self._measure_iter)
         except:
+            self._measure_iter = self._measure()
+            raise
+        if wait is not None:
+            # +1 as ticks_ms() truncates, so a bare wait can be up to 1 ms short
+            self._due = time.ticks_add(time.ticks_ms(), wait + 1)
+            wait += 1
+        return wait
+    
+    def measure(self):
+        '''
+        Blocking measurement of a fresh pair (about 31 ms at oversampling 3).
+        '''
+        while True:
+            wait = self.step()
+            if wait is None:
+                return
+            time.sleep_ms(wait)
+    
+    def latest(self):
+        '''
+        The latest complete pair without touching the bus, as
+        (temperature C, pressure Pa, age s), or None before the first.
+        '''
+        if not self.ready:
+            return None
+        temp = self.temperature(read=False)
+        return temp, self.pressure(read=False), time.ticks_diff(time.ticks_ms(), self.stamp) / 1000
+            
+    def temperature(self, read=True):
+        '''
+        Temperature in degree C, from a fresh measurement if read.
+        '''
+        if read: self.measure()
+        UT = self.UT_raw
+        if UT is None:
             return 0.0
+        if self.integer:
+            X1 = ((UT-self._AC6)*self._AC5) >> 15
+            X2 = _div(self._MC << 11, X1+self._MD)
+            self.B5_raw = X1+X2
+            return ((X1+X2+8) >> 4)/10
         X1 = (UT-self._AC6)*self._AC5/2**15
         X2 = self._MC*2**11/(X1+self._MD)
         self.B5_raw = X1+X2
@@ -93,16 +153,14 @@ class BMP180():
 
     def pressure(self, read=True):
         '''
-        Pressure in mbar.
+        Pressure in Pa.
         '''
         if read: self.temperature(read=read)  # Populate self.B5_raw
-        try:
-            MSB = unp('B', self.MSB_raw)[0]
-            LSB = unp('B', self.LSB_raw)[0]
-            XLSB = unp('B', self.XLSB_raw)[0]
-        except:
+        UP = self.UP_raw
+        if UP is None:
             return 0.0
-        UP = ((MSB << 16)+(LSB << 8)+XLSB) >> (8-self.oversample_setting)
+        if self.integer:
+            return self._pressure_int(UP)
         B6 = self.B5_raw-4000
         X1 = (self._B2*(B6**2/2**12))/2**11
         X2 = self._AC2*B6/2**11
@@ -121,6 +179,44 @@ class BMP180():
         X1 = (X1*3038)/2**16
         X2 = (-7357*pressure)/2**16
         return pressure+(X1+X2+3791)/2**4
+    
+    def _pressure_int(self, UP):
+        '''
+        Datasheet integer compensation. Products that could pass 2**30 are
+        split so intermediates stay MicroPython small ints, except r*k in
+        the B7 division, which reaches about 2**33 at oversampling 0-1.
+        '''
+        oss = self.oversample_setting
+        B6 = self.B5_raw-4000
+        B6sq = (B6*B6) >> 12
+        X1 = (self._B2*B6sq) >> 11
+        X2 = (self._AC2*B6) >> 11
+        X3 = X1+X2
+        B3 = _div(((self._AC1*4+X3) << oss)+2, 4)
+        X1 = (self._AC3*B6) >> 13
+        X2 = (self._B1*B6sq) >> 16
+        X3 = ((X1+X2)+2) >> 2
+        # B4 = AC4*(X3+32768) >> 15 with AC4 split into bytes
+        a = X3+32768
+        hi = (self._AC4 >> 8)*a
+        lo = (self._AC4 & 0xFF)*a
+        B4 = (hi >> 7)+((((hi & 0x7F) << 8)+lo) >> 15)
+        # B7 = (UP-B3)*(50000 >> oss), p = B7*2/B4 computed as q*k + r*k/B4
+        d = UP-B3
+        k = 50000 >> oss
+        if d < 0:
+            p = (((d*k) & 0xFFFFFFFF)//B4)*2 # wraps as unsigned in C, only on bad data
+        elif d <= BMP180._B7_LIMIT[oss]:
+            k *= 2
+            q, r = divmod(d, B4)
+            p = q*k+(r*k)//B4
+        else:
+            q, r = divmod(d, B4)
+            p = (q*k+(r*k)//B4)*2
+        X1 = (p >> 8)*(p >> 8)
+        X1 = (X1*3038) >> 16
+        X2 = (-7357*p) >> 16
+        return p+((X1+X2+3791) >> 4)
 
     def altitude(self, read=True):
         '''
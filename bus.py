@@ -0,0 +1,215 @@
+from i2cmux import I2CMUX
+try:
+    from _thread import allocate_lock, get_ident
+except ImportError:
+    allocate_lock = None
+
+# fastest SCL (Hz) each device supports, unknown devices get standard mode
+MAX_FREQ = {
+    0x10: 400000, # VEML7700
+    0x38: 400000, # AHT10
+    0x77: 400000, # BMP180 (3.4 MHz high speed mode needs a master code), or a mux
+}
+for address in range(0x70, 0x77):
+    MAX_FREQ[address] = 400000 # TCA9548A
+
+class Bus:
+    MUX_ADDRESSES = range(0x70, 0x78) # three address bits, 0x77 clashes with a BMP180
+
+    def __init__(self, i2c, muxes=(0x70,), clock=None, freq=400000):
+        '''
+        Owns the I2C bus and the I2CMUXes on it, and remembers which mux
+        channels are enabled so selecting the current one costs nothing.
+        All mux changes must go through select()/set_masks().
+            i2c - a micropython I2C or SoftI2C object (or a wrapper of one)
+            muxes - addresses of the muxes, see discover()
+            clock - callable setting the SCL frequency of i2c, e.g. re-creating
+                a hardware I2C with the same id, None to leave it as is
+            freq - SCL frequency to run at while no slower device is reachable
+        Channels are numbered across muxes: channel c is channel c % 8 of
+        the mux at muxes[c // 8].
+        Use as a context manager (re-entrant) around a select and the reads
+        that depend on it, so other threads cannot switch the mux in
+        between. Asyncio tasks are serialized by not awaiting inside.
+        '''
+        self.i2c = i2c
+        self.mux_writes = 0
+        self._lock = allocate_lock() if allocate_lock is not None else None
+        self._owner = None
+        self._depth = 0
+        self.clock = clock
+        self.freq = freq
+        self.current_freq = None
+        self._slow = {} # channel (None for the main bus): lowest MAX_FREQ of the devices there below freq
+        self.set_muxes(muxes)
+        self._retime()
+
+    def __enter__(self):
+        if self._lock is not None:
+            me = get_ident()
+            if self._owner != me:
+                self._lock.acquire()
+                self._owner = me
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0 and self._lock is not None:
+            self._owner = None
+            self._lock.release()
+
+    def set_muxes(self, addresses):
+        self.muxes = [I2CMUX(self.i2c, address) for address in addresses]
+        self.masks = [None] * len(self.muxes) # enabled channels per mux, None if unknown
+        for address in addresses:
+            self.attach(address)
+    
+    def attach(self, address, channel=None):
+        '''
+        Note a device at address on channel (None for the main bus). Every
+        device hears all traffic on the enabled channels, so the clock is
+        the slowest MAX_FREQ among them: fast mode runs wherever all
+        devices support it and a slow one only slows its own channel.
+        '''
+        freq = MAX_FREQ.get(address, 100000)
+        if freq < self.slowest(channel):
+            self._slow[channel] = freq
+        self._retime()
+    
+    def slowest(self, channel=None):
+        '''
+        The clock devices on channel (None for the main bus) allow.
+        '''
+        return self._slow.get(channel, self.freq)
+
+    def _retime(self):
+        if self.clock is None:
+            return
+        freq = self.freq
+        for channel,slow in self._slow.items():
+            if slow < freq:
+                if channel is not None:
+                    mask = self.masks[channel >> 3]
+                    if mask is not None and not mask & (1 << (channel & 7)):
+                        continue
+                freq = slow
+        if freq != self.current_freq:
+            self.clock(freq)
+            self.current_freq = freq
+
+    def discover(self):
+        '''
+        Use every mux answering at 0x70-0x77, in address order, and disable
+        all their channels. A device there only counts as a mux if it reads
+        back the masks written to it, which rules out a BMP180 at 0x77.
+        Returns the addresses.
+        '''
+        found = []
+        with self:
+            for address in self.i2c.scan():
+                if address not in Bus.MUX_ADDRESSES:
+                    continue
+                mux = I2CMUX(self.i2c, address)
+                try:
+                    mux.set_state(mask=0xA5)
+                    if mux.get_state()[0] != 0xA5:
+                        continue
+                    mux.set_state(mask=0)
+                    if mux.get_state()[0] != 0:
+                        continue
+                except:
+                    continue
+                found.append(address)
+            self.set_muxes(found)
+            for m in range(len(found)):
+                self.masks[m] = 0
+        return found
+
+    def find(self, address):
+        '''
+        The channels with a device at address, scanning each mux with all of
+        its channels enabled first so muxes without one cost a single scan.
+        '''
+        channels = []
+        with self:
+            for m in range(len(self.muxes)):
+                self._only(m, 0xFF)
+                if address not in self.i2c.scan():
+                    continue
+                for c in range(m*8, m*8 + 8):
+                    self.select(c)
+                    if address in self.i2c.scan():
+                        channels.append(c)
+        return channels
+
+    def _write(self, m, mask):
+        self.masks[m] = None # unknown if the write fails
+        self.muxes[m].set_state(mask=mask)
+        self.masks[m] = mask
+        self.mux_writes += 1
+        if self._slow:
+            self._retime()
+
+    def set_masks(self, masks):
+        '''
+        Enable exactly the channels in masks[m] on each mux m, writing only
+        the muxes that change. Muxes losing channels are written first, so
+        channels of two muxes are not enabled together in between.
+        '''
+        for m,mask in enumerate(masks):
+            current = self.masks[m]
+            if current is None or current & ~mask:
+                self._write(m, mask)
+        for m,mask in enumerate(masks):
+            if self.masks[m] != mask:
+                self._write(m, mask)
+
+    def _only(self, m, mask):
+        '''
+        Enable mask on mux m with every other mux disabled first.
+        '''
+        for i in range(len(self.muxes)):
+            if i != m and self.masks[i] != 0:
+                self._write(i, 0)
+        if self.masks[m] != mask:
+            self._write(m, mask)
+
+    def select(self, channel, exclusive=True):
+        '''
+        Make the devices on channel reachable. exclusive=False accepts other
+        channels staying enabled, for devices whose address is not repeated
+        on them.
+        '''
+        m = channel >> 3
+        mask = 1 << (channel & 7)
+        if not exclusive:
+            current = self.masks[m]
+            if current is None or not current & mask:
+                self._write(m, mask)
+            return
+        self._only(m, mask)
+
+    def selected(self):
+        '''
+        The one channel enabled on the whole bus, else None.
+        '''
+        channel = None
+        for m,mask in enumerate(self.masks):
+            if mask == 0:
+                continue
+            if channel is not None or mask is None or mask & (mask - 1):
+                return None
+            channel = m*8
+            while mask > 1:
+                mask >>= 1
+                channel += 1
+        return channel
+
+    def ordered(self, channels):
+        '''
+        channels in the order that selects each once: the currently
+        selected one first, then ascending, which also switches mux once.
+        '''
+        current = self.selected()
+        return sorted(channels, key=lambda channel: (channel != current, channel))
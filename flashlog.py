@@ -0,0 +1,203 @@
+import os
+import struct
+import time
+
+class FlashLog:
+    RECORD = '<IBf' # timestamp (s), channel id, value
+    RECORD_SIZE = struct.calcsize(RECORD)
+    CHANNELS = 'channels.txt'
+    SUFFIX = '.seg'
+    
+    def __init__(self, path='/log', segment_records=4096, max_segments=16, batch=64):
+        '''
+        Append-only log of sensor readings in fixed-size binary records.
+            path - directory holding the segment files
+            segment_records - records per segment before rotating to a new one
+            max_segments - oldest segments are deleted beyond this count
+            batch - records buffered in RAM per write to flash
+        Segment files are named after the timestamp of their first record
+        (bumped so names keep increasing in the order written), and the
+        first and last timestamps of every segment are kept in self.spans,
+        the index a range query uses to open only the segments it overlaps.
+        The clock restarts near 2000 after a power loss until it is set
+        again, so a timestamp older than the last one starts a new segment:
+        records are in time order within a segment, not across segments.
+        '''
+        self.path = path
+        self.segment_records = segment_records
+        self.max_segments = max_segments
+        self.batch = batch
+        self._buf = bytearray(batch * FlashLog.RECORD_SIZE)
+        self._pending = 0
+        
+        try:
+            os.mkdir(path)
+        except OSError:
+            pass # already exists
+        
+        self.channels = []
+        try:
+            with open(self._file(FlashLog.CHANNELS), 'r') as f:
+                for line in f:
+                    self.channels.append(line.strip())
+        except OSError:
+            pass
+        self._ids = {}
+        for i,name in enumerate(self.channels):
+            self._ids[name] = i
+        
+        self.segments = []
+        for name in os.listdir(path):
+            if name.endswith(FlashLog.SUFFIX):
+                self.segments.append(int(name[:-len(FlashLog.SUFFIX)]))
+        self.segments.sort()
+        self.spans = [self._read_span(start) for start in self.segments] # [first, last] timestamp, None if empty
+        self._last = None # timestamp of the latest record
+        for span in self.spans:
+            if span is not None:
+                self._last = span[1]
+        
+        self._count = self.segment_records # records in the active segment
+        if len(self.segments) > 0:
+            size = os.stat(self._segment_file(self.segments[-1]))[6]
+            if size % FlashLog.RECORD_SIZE == 0: # else a torn write, start fresh
+                self._count = size // FlashLog.RECORD_SIZE
+                
+    def _file(self, name):
+        return f'{self.path}/{name}'
+    
+    def _segment_file(self, start):
+        return self._file(f'{start:010d}{FlashLog.SUFFIX}')
+    
+    def _read_span(self, start):
+        '''
+        Timestamps of the first and last whole record of a segment, or None.
+        '''
+        try:
+            with open(self._segment_file(start), 'rb') as f:
+                n = os.stat(self._segment_file(start))[6] // FlashLog.RECORD_SIZE
+                if n == 0:
+                    return None
+                first = struct.unpack('<I', f.read(4))[0]
+                f.seek((n - 1) * FlashLog.RECORD_SIZE)
+                return [first, struct.unpack('<I', f.read(4))[0]]
+        except OSError:
+            return None
+    
+    def channel_id(self, name):
+        '''
+        Returns the id stored in records for a channel, assigning a new one
+        (persisted to flash) the first time a channel is seen.
+        '''
+        cid = self._ids.get(name)
+        if cid is None:
+            assert len(self.channels) < 256, 'Too many log channels'
+            cid = len(self.channels)
+            with open(self._file(FlashLog.CHANNELS), 'a') as f:
+                f.write(f'{name}\n')
+            self.channels.append(name)
+            self._ids[name] = cid
+        return cid
+        
+    def append(self, name, value, timestamp=None):
+        '''
+        Buffer a reading, writing to flash once a full batch is collected.
+        Missing readings (None) are not logged.
+        '''
+        if value is None:
+            return
+        if timestamp is None:
+            timestamp = int(time.time())
+        if self._last is not None and timestamp < self._last:
+            # the clock went back, keep each segment in time order
+            self.flush()
+            self._count = self.segment_records
+        self._last = timestamp
+        struct.pack_into(FlashLog.RECORD, self._buf, self._pending * FlashLog.RECORD_SIZE,
+                         timestamp, self.channel_id(name), value)
+        self._pending += 1
+        if self._pending == self.batch:
+            self.flush()
+            
+    def flush(self):
+        '''
+        Write buffered records to the active segment in a single write.
+        '''
+        if self._pending == 0:
+            return
+        first = struct.unpack_from('<I', self._buf, 0)[0]
+        if self._count >= self.segment_records:
+            self._rotate(first)
+        with open(self._segment_file(self.segments[-1]), 'ab') as f:
+            f.write(memoryview(self._buf)[:self._pending * FlashLog.RECORD_SIZE])
+        if self.spans[-1] is None:
+            self.spans[-1] = [first, self._last]
+        else:
+            self.spans[-1][1] = self._last
+        self._count += self._pending
+        self._pending = 0
+        
+    def _rotate(self, start):
+        if len(self.segments) > 0 and start <= self.segments[-1]:
+            start = self.segments[-1] + 1 # names must stay unique and ordered
+        self.segments.append(start)
+        self.spans.append(None)
+        self._count = 0
+        while len(self.segments) > self.max_segments:
+            os.remove(self._segment_file(self.segments.pop(0)))
+            self.spans.pop(0)
+        
+    def _first_record(self, f, size, since):
+        lo = 0
+        hi = size // FlashLog.RECORD_SIZE
+        while lo < hi: # records are in time order within a segment
+            mid = (lo + hi) // 2
+            f.seek(mid * FlashLog.RECORD_SIZE)
+            if struct.unpack('<I', f.read(4))[0] > since:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+        
+    def query(self, since=0, until=None, channels=None):
+        '''
+        Yields (timestamp, channel, value) for records newer than since (and
+        no newer than until) in the order they were logged, which is oldest
+        first unless the clock went back, optionally limited to a set of
+        channel names. Unflushed records are included.
+        '''
+        if channels is not None:
+            channels = set(self._ids[name] for name in channels if name in self._ids)
+        buf = bytearray(self.batch * FlashLog.RECORD_SIZE)
+        for k in range(len(self.segments)):
+            span = self.spans[k]
+            if span is None or span[1] <= since or (until is not None and span[0] > until):
+                continue # nothing in range
+            try:
+                f = open(self._segment_file(self.segments[k]), 'rb')
+            except OSError:
+                continue
+            with f:
+                if span[0] <= since:
+                    size = os.stat(self._segment_file(self.segments[k]))[6]
+                    f.seek(self._first_record(f, size, since) * FlashLog.RECORD_SIZE)
+                done = False
+                while not done and (n := f.readinto(buf)) >= FlashLog.RECORD_SIZE:
+                    for rec in self._records(buf, n // FlashLog.RECORD_SIZE, since, until, channels):
+                        if rec is None:
+                            done = True # past until in this segment
+                            break
+                        yield rec
+        for rec in self._records(self._buf, self._pending, since, until, channels):
+            if rec is None:
+                return
+            yield rec
+        
+    def _records(self, buf, count, since, until, channels):
+        for i in range(count):
+            t,cid,value = struct.unpack_from(FlashLog.RECORD, buf, i * FlashLog.RECORD_SIZE)
+            if until is not None and t > until:
+                yield None # past the end of the range
+                return
+            if t > since and (channels is None or cid in channels):
+                yield t, self.channels[cid], value
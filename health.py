@@ -0,0 +1,95 @@
+from array import array
+import time
+
+class Health:
+
+    def __init__(self, names=(), threshold=3, backoff_ms=2000, max_backoff_ms=300000):
+        '''
+        Circuit breaker per named sensor. After threshold consecutive
+        failures a sensor is down: due() is False until its backoff has
+        passed. A retry that gets as far as re-initializing it leaves it
+        half-open (probe()): it may be read again, but keeps its backoff,
+        so only a good read brings it back up and a failed one doubles
+        the backoff (up to max_backoff_ms).
+        '''
+        self.threshold = threshold
+        self.backoff_ms = backoff_ms
+        self.max_backoff_ms = max_backoff_ms
+        self.names = []
+        self.index = {}
+        self.failures = array('I') # consecutive
+        self.backoff = array('I') # ms, 0 while up
+        self.retry_at = array('I') # ticks_ms
+        self.probing = array('B') # half-open, see probe()
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        '''
+        Returns the slot of name, adding it if new.
+        '''
+        if name in self.index:
+            return self.index[name]
+        self.index[name] = len(self.names)
+        self.names.append(name)
+        for counter in (self.failures, self.backoff, self.retry_at, self.probing):
+            counter.append(0)
+        return self.index[name]
+
+    def down(self, i):
+        return self.backoff[i] != 0
+
+    def ok(self, i):
+        '''
+        Whether the last use of sensor i succeeded.
+        '''
+        return self.failures[i] == 0
+
+    def due(self, i):
+        '''
+        Whether sensor i may be used: it is up, or its retry has come.
+        '''
+        return self.backoff[i] == 0 or time.ticks_diff(time.ticks_ms(), self.retry_at[i]) >= 0
+
+    def probe(self, i):
+        '''
+        Let down sensor i be read while a retry finds out if it works.
+        '''
+        self.probing[i] = 1
+    
+    def succeeded(self, i):
+        self.failures[i] = 0
+        self.backoff[i] = 0
+        self.probing[i] = 0
+
+    def failed(self, i, trip=False):
+        '''
+        Count a failure of sensor i, taking it down now if trip.
+        '''
+        self.failures[i] += 1
+        self.probing[i] = 0
+        if self.backoff[i] != 0:
+            self._retry(i, min(self.backoff[i] * 2, self.max_backoff_ms))
+        elif trip or self.failures[i] >= self.threshold:
+            self._retry(i, self.backoff_ms)
+
+    def _retry(self, i, backoff_ms):
+        self.backoff[i] = backoff_ms
+        self.retry_at[i] = time.ticks_add(time.ticks_ms(), backoff_ms)
+
+    def report(self):
+        '''
+        Returns {name: {up, probing, failures, retry_in}} with the time to
+        the next retry of a down sensor in seconds.
+        '''
+        now = time.ticks_ms()
+        report = {}
+        for i,name in enumerate(self.names):
+            down = self.backoff[i] != 0
+            report[name] = {
+                'up': not down,
+                'probing': self.probing[i] == 1,
+                'failures': self.failures[i],
+                'retry_in': max(time.ticks_diff(self.retry_at[i], now), 0) / 1000 if down else None,
+            }
+        return report
@@ -0,0 +1,76 @@
+from array import array
+import time
+
+class Ring:
+    
+    def __init__(self, size):
+        '''
+        Fixed-size ring buffer of timestamped samples stored in packed arrays.
+            size - number of samples kept before the oldest are overwritten
+        '''
+        self.size = size
+        self.times = array('I', (0 for i in range(size))) # seconds since epoch
+        self.values = array('f', (0 for i in range(size)))
+        self.count = 0 # total samples ever pushed
+        
+    def __len__(self):
+        return min(self.count, self.size)
+        
+    def push(self, timestamp, value):
+        i = self.count % self.size
+        self.times[i] = timestamp
+        self.values[i] = value
+        self.count += 1
+        
+    def since(self, timestamp):
+        '''
+        Yields (timestamp, value) for buffered samples strictly newer than
+        timestamp, oldest first.
+        '''
+        lo = self.count - len(self)
+        hi = self.count
+        while lo < hi: # samples are in time order, so bisect for the start
+            mid = (lo + hi) // 2
+            if self.times[mid % self.size] > timestamp:
+                hi = mid
+            else:
+                lo = mid + 1
+        for k in range(lo, self.count):
+            i = k % self.size
+            yield self.times[i], self.values[i]
+
+class History:
+    
+    def __init__(self, size=240):
+        '''
+        On-device time series of sensor readings, one Ring per channel.
+            size - samples kept per channel
+        '''
+        self.size = size
+        self.channels = {}
+        
+    def add_channel(self, name):
+        if name not in self.channels:
+            self.channels[name] = Ring(self.size)
+        
+    def record(self, name, value, timestamp=None):
+        '''
+        Append a sample to a channel. Missing readings (None) are not stored.
+        '''
+        ring = self.channels.get(name)
+        if ring is None or value is None:
+            return
+        if timestamp is None:
+            timestamp = int(time.time())
+        ring.push(timestamp, value)
+        
+    def query(self, since=0, channels=None):
+        '''
+        Yields (timestamp, channel, value) for samples newer than since, one
+        channel at a time, for the given channel names or every channel if None.
+        '''
+        if channels is None:
+            channels = self.channels.keys()
+        for name in channels:
+            for t,v in self.channels[name].since(since):
+                yield t, name, v
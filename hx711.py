@@ -1,4 +1,7 @@
+import math
+import micropython
 import time
+from array import array
 from machine import Pin
 
 class HX711:
@@ -6,7 +9,7 @@ class HX711:
     READ_A_64 = 2
     READ_B_32 = 3
     
-    def __init__(self,  clk=15, dat=2, mode=READ_A_128, scale=0.00005, offset=245500, tare=0.0):
+    def __init__(self,  clk=15, dat=2, mode=READ_A_128, scale=0.00005, offset=245500, tare=0.0, stderr=None, min_cycles=3):
         '''
         This device does not have a nice interface, but rather a:
             clk(15) - gpio pin that controls the state and clocks out data on the
@@ -15,24 +18,41 @@ class HX711:
             scale - grams per count of raw value
             offset - subtracted from raw value prior to unit conversion
             tare - subtracted after conversion to grams
+            stderr - weight() stops early once the standard error of the mean
+                (in output units) is at most this, None always takes all cycles
+            min_cycles - conversions taken before trusting the standard error
         '''
         self.scale = scale
         self.offset = offset
         self.tare = tare
+        self.stderr = stderr
+        self.min_cycles = min_cycles
+        self.samples = 0 # conversions used by the last weight()
+        self._values = array('i', (0 for _ in range(16)))
+        self.running = False # converting in the background, see start()
         self.clk = Pin(clk, Pin.OUT)
         self.dat = Pin(dat, Pin.IN)
         #reset
         self.clk.value(1)
-        self.set_mode(mode)
+        if mode == HX711.READ_A_128:
+            self._mode = mode # the power up default, no conversion needed to select it
+        else:
+            self.set_mode(mode)
         
     def set_mode(self, mode):
         assert mode > 0 and mode < 4, f'Number of mode pulses ({mode}) is invalid'
         self._mode = mode
         self._read()
         
-    def weight(self, cycles=8, scale=None, offset=None, tare=None):
+    def weight(self, cycles=8, scale=None, offset=None, tare=None, stderr=None):
         '''
-        Measure the weight with some number of averaging cycles.
+        Measure the weight with up to some number of averaging cycles, fewer
+        if the standard error drops below stderr first. Spikes are rejected
+        by taking the median of 3 or the mean of the middle half of 4 or more
+        samples. The number of samples used is left in self.samples.
+        After start() the newest queued conversions are averaged without
+        blocking, otherwise the chip is woken once and converts continuously
+        for all cycles.
         kwargs override object defaults if set
         '''
         if scale is None:
@@ -41,19 +61,193 @@ class HX711:
             tare = self.tare
         if offset is None:
             offset = self.offset
-        avg = 0
+        if stderr is None:
+            stderr = self.stderr
+        if self.running:
+            n = self._average(self._queued(), cycles, scale, stderr)
+        else:
+            self._wake()
+            try:
+                n = self._average(lambda i: self._read(reset=False), cycles, scale, stderr)
+            finally:
+                self.clk.value(1) # power down until the next measurement
+        self.samples = n
+        ordered = sorted(self._values[:n])
+        trim = n // 4 if n > 3 else n // 3
+        kept = ordered[trim:n - trim]
+        return (sum(kept) / len(kept) - offset) * scale - tare
+    
+    def _average(self, source, cycles, scale, stderr):
+        '''
+        Fill self._values with source(i) until cycles values, source returns
+        None or the standard error is at most stderr. Returns the count.
+        '''
+        if len(self._values) < cycles:
+            self._values = array('i', (0 for _ in range(cycles)))
+        values = self._values
+        n = 0
+        mean = 0.0
+        m2 = 0.0 # sum of squared deviations (Welford)
         for i in range(cycles):
-            val = self._read()
-            if val > 0x7fffff:
-                val -= 0x1000000
-            avg += val
-        return (avg / cycles - offset) * scale - tare
-        
-    def _read(self):
+            val = source(i)
+            if val is None:
+                break
+            values[n] = val
+            n += 1
+            delta = val - mean
+            mean += delta / n
+            m2 += delta * (val - mean)
+            if stderr is not None and n >= self.min_cycles and math.sqrt(m2 / (n - 1) / n) * abs(scale) <= stderr:
+                break
+        return n
+    
+    def start(self, queue=16, stream=0, decimate=1, smoothing=0):
+        '''
+        Convert continuously in the background at the chip's native rate.
+        A falling edge on DOUT (conversion ready) schedules the clock-out,
+        and results go into a ring of the last queue conversions which
+        weight() averages without blocking. stop() returns to blocking reads.
+            stream - size of a ring of filtered samples for stream(), 0 for none
+            decimate - conversions averaged into each stream sample (at most 64)
+            smoothing - k of a low-pass y += (x - y) >> k on the stream
+                samples, a time constant of about 2**k samples, 0 for none
+        Filtering is done in integer counts, so keeping up with 80 SPS does
+        not allocate.
+        '''
+        assert 0 < decimate <= 64, 'decimate must be 1-64' # sums stay small ints
+        self._ring = array('i', (0 for _ in range(queue)))
+        self._head = 0
+        self.seq = 0 # conversions queued since start()
+        self._stream = array('i', (0 for _ in range(stream))) if stream else None
+        self._stream_head = 0
+        self.stream_seq = 0 # stream samples since start(), the newest has this seq
+        self.stream_stamp = time.ticks_ms() # of the newest stream sample
+        self._decimate = decimate
+        self._smoothing = smoothing
+        self._sum = 0
+        self._phase = 0
+        self._filtered = 0
+        self.stamp = time.ticks_ms() # of the last conversion, or of start()
+        self._busy = False
+        self._collect_ref = self._collect # bound once, the IRQ handler must not allocate
+        self.running = True
+        self.dat.irq(trigger=Pin.IRQ_FALLING, handler=self._irq)
+        self.clk.value(0) # wake, the first result takes 4 conversions to settle
+    
+    def stop(self):
+        self.dat.irq(handler=None)
+        self.running = False
+        self.clk.value(1)
+    
+    def _irq(self, pin):
+        if self._busy:
+            return # a data bit during clock-out, or already scheduled
+        self._busy = True
+        try:
+            micropython.schedule(self._collect_ref, 0)
+        except RuntimeError:
+            self._busy = False # schedule queue full, weight() picks it up
+    
+    def _collect(self, _):
+        try:
+            if self.dat.value():
+                return # stale edge, no conversion ready
+            val = self._shift()
+            self._ring[self._head] = val
+            self._head = (self._head + 1) % len(self._ring)
+            self.seq += 1
+            self.stamp = time.ticks_ms()
+            if self._stream is not None:
+                self._sum += val
+                self._phase += 1
+                if self._phase == self._decimate:
+                    self._push(self._sum // self._decimate)
+                    self._sum = 0
+                    self._phase = 0
+        finally:
+            self._busy = False
+    
+    def _push(self, val):
+        if self.stream_seq == 0:
+            self._filtered = val # start the low-pass at the first sample, not at 0
+        else:
+            self._filtered += (val - self._filtered) >> self._smoothing
+        self._stream[self._stream_head] = self._filtered
+        self._stream_head = (self._stream_head + 1) % len(self._stream)
+        self.stream_seq += 1
+        self.stream_stamp = self.stamp
+    
+    def stream(self, since=0, until=None):
+        '''
+        Yields (seq, weight) for the stream samples still buffered with seq
+        strictly newer than since, up to until (default the newest), oldest
+        first. seq counts up from 1, so a client passes back the last seq
+        it has.
+        '''
+        assert self.running and self._stream is not None, 'Weight streaming is not running'
+        self.poll()
+        while True: # a consistent pair, _push() may run in between
+            seq = self.stream_seq
+            head = self._stream_head
+            if seq == self.stream_seq:
+                break
+        if until is None or until > seq:
+            until = seq
+        ring = self._stream
+        size = len(ring)
+        first = max(since, until - size, 0) + 1
+        for k in range(first, until + 1):
+            val = ring[(head - 1 - (seq - k)) % size]
+            if k <= self.stream_seq - size:
+                continue # overwritten while streaming
+            yield k, round((val - self.offset) * self.scale - self.tare, 6)
+    
+    def poll(self):
+        '''
+        Restart the background conversions if a DOUT edge was missed: the
+        chip then holds DOUT low with a result ready and never interrupts
+        again. Call regularly while running; weight(), stream() and
+        Sensors.sample() do.
+        '''
+        if self.running and time.ticks_diff(time.ticks_ms(), self.stamp) > 500 and not self._busy:
+            self._busy = True
+            self._collect(0)
+    
+    def _queued(self):
+        '''
+        Source for _average() of the queued conversions, newest first.
+        Right after start() this waits for the chip to settle.
+        '''
+        while self.seq == 0 and time.ticks_diff(time.ticks_ms(), self.stamp) < 1000:
+            time.sleep_ms(5) # scheduled clock-outs run meanwhile
+        self.poll()
+        available = min(self.seq, len(self._ring))
+        assert available > 0, 'No HX711 conversions queued yet'
+        assert time.ticks_diff(time.ticks_ms(), self.stamp) < 2000, 'HX711 stopped converting'
+        ring = self._ring
+        head = self._head
+        def source(i):
+            if i >= available:
+                return None
+            return ring[(head - 1 - i) % len(ring)]
+        return source
+    
+    def _wake(self):
+        '''
+        Power cycle the chip, which then needs 4 conversions to settle.
+        '''
         self.clk.value(1)
         time.sleep_ms(1)
         self.clk.value(0)
         time.sleep_ms(1)
+        
+    def _read(self, reset=True):
+        '''
+        Clock out one conversion. With reset the chip is woken first and
+        powered down after, otherwise it must be awake and is left running.
+        '''
+        if reset:
+            self._wake()
         i = 0
         while self.dat.value():
             time.sleep_ms(1)
@@ -61,6 +255,15 @@ class HX711:
             if i > 500:
                 print('Read timed out')
                 break
+        val = self._shift()
+        if reset:
+            self.clk.value(1)
+        return val
+    
+    def _shift(self):
+        '''
+        Clock out a ready conversion as a signed count, then the gain pulses.
+        '''
         val = 0
         for i in range(24):
             self.clk.value(1)
@@ -69,5 +272,6 @@ class HX711:
         for i in range(self._mode):
             self.clk.value(1)
             self.clk.value(0)
-        self.clk.value(1)
+        if val > 0x7fffff:
+            val -= 0x1000000
         return val
@@ -1,13 +1,19 @@
 import machine
 import network
-from machine import SoftI2C, SoftSPI, Pin
+import time
+from machine import I2C, SoftSPI, Pin
 
 try: # webrepl gets unhappy if the whole thing unwinds
     
     
+    try:
+        import asyncio
+    except ImportError:
+        import uasyncio as asyncio
     from server import JSONServer
     from sensors import Sensors
-    from ili9341 import ILI9341, color565, fcolor565
+    from flashlog import FlashLog
+    from metrics import Metrics
 
     lan = network.LAN(
         mdc = machine.Pin(23),
@@ -25,15 +31,32 @@ try: # webrepl gets unhappy if the whole thing unwinds
     )
 
     spi = SoftSPI(baudrate=200000, sck=Pin(14), mosi=Pin(2), miso=Pin(15))
-    i2c = SoftI2C(scl=Pin(16), sda=Pin(13), freq=100000)
+    def i2c_clock(freq):
+        # the hardware peripheral, constructing it again just changes its clock
+        return I2C(0, scl=Pin(16), sda=Pin(13), freq=freq)
+    i2c = i2c_clock(400000)
     weight_pins = (4, 36) # (clk, dat)
-    TOTAL_AHT10 = 5
-    sensors = Sensors(i2c, spi, weight_pins=weight_pins, bmp180=True, veml7700=True, aht10=TOTAL_AHT10)
+    TOTAL_AHT10 = None # find every AHT10 behind the muxes
+    I2C_MUXES = None # discover the muxes at 0x70-0x77
+    ASYNC_SERVER = True # serve concurrent clients on the asyncio event loop
+    sensors = Sensors(i2c, spi, weight_pins=weight_pins, bmp180=True, veml7700=True, aht10=TOTAL_AHT10, muxes=I2C_MUXES, i2c_clock=i2c_clock, cache='sensors.json')
+    sensors_ms = time.ticks_ms() # since reset
     
     if len(sensors.init_issues) > 0:
         print('\n'.join(sensors.init_issues))
+    if sensors.weight is not None:
+        sensors.weight.stderr = 0.001 # kg, a steady hive needs only a few conversions
+        # convert in the background so weight reads do not block, and keep the
+        # last 800 samples (10 s at 80 SPS) for /weight/stream
+        sensors.weight.start(stream=800, decimate=1, smoothing=0)
+    
+    # sampling periods (ms) for the background snapshot served by the endpoints
+    log = FlashLog('log', segment_records=4096, max_segments=16, batch=64)
+    # no warm-up here: the server's idle hook takes the first samples while
+    # it already answers (with nulls until then)
+    sensors.schedule(lux=1000, barometer=5000, temp_humid=30000, weight=10000, history=240, log=log)
         
-    server = JSONServer()
+    server = JSONServer(timeout=5, keep_alive=5, max_requests=32)
 
     def handle_hello(req):
         req.reply(msg='hello')
@@ -41,43 +64,75 @@ try: # webrepl gets unhappy if the whole thing unwinds
 
     def handle_report(req):
         try:
-            report = sensors.report()
-            req.reply(**report)
+            req.reply(**sensors.latest())
         except Exception as e:
             req.error(str(e), code=500)
     server.add_endpoint('GET', '/report', handle_report)
     
+    def handle_read(req):
+        fields = req.query.get('fields')
+        if not fields:
+            req.error('fields must list the readings to take, e.g. ?fields=lux,weight')
+            return
+        try:
+            # answer from the background samples when they are recent enough,
+            # a hardware read blocks the event loop for every other client
+            max_age = float(req.query.get('max_age', 60))
+            values = sensors.read(fields.split(','), max_age=max_age)
+        except ValueError as e:
+            req.error(str(e))
+            return
+        except Exception as e:
+            req.error(str(e), code=500)
+            return
+        req.reply(**values)
+    server.add_endpoint('GET', '/read', handle_read)
+    
     def handle_lux(req):
         try:
-            lux = sensors.read_lux()
-            req.reply(ambient_lux=lux)
+            req.reply(**sensors.latest('ambient_lux'))
         except Exception as e:
             req.error(str(e), code=500)
     server.add_endpoint('GET', '/lux', handle_lux)
     
     def handle_weight(req):
         try:
-            weight = sensors.read_weight()
-            req.reply(weight=weight)
+            values = sensors.latest('weight')
+            if sensors.weight is not None:
+                values['samples'] = sensors.weight.samples # conversions averaged
+            req.reply(**values)
         except Exception as e:
             req.error(str(e), code=500)
     server.add_endpoint('GET', '/weight', handle_weight)
     
+    def handle_weight_stream(req):
+        try:
+            since = int(req.query.get('since', 0))
+            hx = sensors.weight
+            if hx is None or not hx.running:
+                req.error('Weight streaming is not running')
+                return
+            last = hx.stream_seq
+            age = time.ticks_diff(time.ticks_ms(), hx.stream_stamp) / 1000
+            req.stream(hx.stream(since, last), key='samples', last=last, age=age)
+        except Exception as e:
+            req.error(str(e), code=500)
+    server.add_endpoint('GET', '/weight/stream', handle_weight_stream)
+    
     def handle_barometer(req):
         try:
-            t,p = sensors.read_temp_pressure()
-            req.reply(ext_temperature=t, ext_pressure=p)
+            req.reply(**sensors.latest('ext_temperature', 'ext_pressure'))
         except Exception as e:
             req.error(str(e), code=500)
     server.add_endpoint('GET', '/barometer', handle_barometer)
     
     def handle_temp_humid(req):
         try:
-            params = {}
-            for i,(temp,humid) in enumerate(sensors.read_all_temp_humid()):
-                params[f'temperature_{i}'] = temp
-                params[f'humidity_{i}'] = humid
-            req.reply(**params)
+            keys = []
+            for i in range(len(sensors.ahts)):
+                keys.append(f'temperature_{i}')
+                keys.append(f'humidity_{i}')
+            req.reply(**sensors.latest(*keys))
         except Exception as e:
             req.error(str(e), code=500)
     server.add_endpoint('GET', f'/temp_humid', handle_temp_humid)
@@ -85,29 +140,92 @@ try: # webrepl gets unhappy if the whole thing unwinds
     def generate_handler(idx):
         def _handler(req):
             try:
-                t,h = sensors.read_temp_humid(idx)
-                params = {
-                    f'temperature_{idx}': t,
-                    f'humidity_{idx}': h
-                }
-                req.reply(**params)
+                req.reply(**sensors.latest(f'temperature_{idx}', f'humidity_{idx}'))
             except Exception as e:
                 req.error(str(e), code=500)
         return _handler            
     
-    for idx in range(TOTAL_AHT10):
+    for idx in range(len(sensors.ahts)):
         server.add_endpoint('GET', f'/temp_humid/{idx}', generate_handler(idx))
 
+    def handle_history(req):
+        try:
+            since = int(req.query.get('since', 0))
+            channels = req.query.get('channel')
+            if channels is not None:
+                channels = channels.split(',')
+                for channel in channels:
+                    if channel not in sensors.history.channels:
+                        req.error(f'Unknown channel {channel}')
+                        return
+            req.stream(sensors.history.query(since, channels), now=int(time.time()))
+        except Exception as e:
+            req.error(str(e), code=500)
+    server.add_endpoint('GET', '/history', handle_history)
+
+    def handle_log(req):
+        try:
+            since = int(req.query.get('since', 0))
+            until = req.query.get('until')
+            if until is not None:
+                until = int(until)
+            channels = req.query.get('channel')
+            if channels is not None:
+                channels = channels.split(',')
+            req.stream(log.query(since, until, channels), now=int(time.time()))
+        except Exception as e:
+            req.error(str(e), code=500)
+    server.add_endpoint('GET', '/log', handle_log)
+
+    metrics = Metrics(sensors, server)
+    def handle_metrics(req):
+        try:
+            req.send(metrics.render(), content_type=Metrics.CONTENT_TYPE)
+        except Exception as e:
+            req.error(str(e), code=500)
+    server.add_endpoint('GET', '/metrics', handle_metrics)
+
+    def handle_stats(req):
+        try:
+            req.reply(**sensors.stats.report())
+        except Exception as e:
+            req.error(str(e), code=500)
+    server.add_endpoint('GET', '/stats', handle_stats)
+    
+    def handle_stats_reset(req):
+        sensors.stats.reset()
+        req.reply(msg='stats reset')
+    server.add_endpoint('POST', '/stats/reset', handle_stats_reset)
+
+    def handle_health(req):
+        try:
+            req.reply(**sensors.health.report())
+        except Exception as e:
+            req.error(str(e), code=500)
+    server.add_endpoint('GET', '/health', handle_health)
+
     def handle_init_log(req):
         try:
-            req.reply(init_log=sensors.init_issues)
+            req.reply(init_log=sensors.init_issues, boot={ # ms since reset
+                'sensors_ready': sensors_ms,
+                'listening': server.listening_ms,
+                'first_response': server.first_request_ms,
+            })
         except Exception as e:
             req.error(str(e), code=500)
     server.add_endpoint('GET', '/init_log', handle_init_log)
     
+    async def reset_soon():
+        await asyncio.sleep(0.5) # let the event loop flush the reply first
+        machine.reset()
+    
     def handle_reset(req):
         req.reply(msg='resetting')
-        machine.reset()
+        log.flush()
+        if ASYNC_SERVER:
+            asyncio.create_task(reset_soon())
+        else:
+            machine.reset()
     server.add_endpoint('POST', '/reset', handle_reset)
 
     def handle_repl(req):
@@ -115,8 +233,12 @@ try: # webrepl gets unhappy if the whole thing unwinds
         raise Exception('dropping to repl')
     server.add_endpoint('POST', '/repl', handle_repl)
 
-    print('Waiting for requests...')
-    server.serve()
+    if __name__ == '__main__': # importing main (e.g. from bench.py) only sets up
+        print('Waiting for requests...')
+        if ASYNC_SERVER:
+            asyncio.run(server.serve_async(idle=sensors.sample, idle_ms=50))
+        else:
+            server.serve(idle=sensors.sample)
 
 except Exception as e:
     print(e)
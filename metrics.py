@@ -0,0 +1,112 @@
+import time
+
+class Metrics:
+    CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+    # OpenMetrics unit names for the units given by Sensors.report_unit()
+    UNITS = {'C': 'celsius', 'kPa': 'kilopascals', '%': 'percent', 'kg': 'kilograms', 'm': 'meters'}
+    
+    def __init__(self, sensors, server=None, prefix='beelogger'):
+        '''
+        Renders the sampled Sensors snapshot and internal counters in the
+        OpenMetrics text format. Metric names and label sets are rendered to
+        bytes once here, so a scrape only formats the numbers.
+        Build this after Sensors.schedule() so every sampled key is known.
+        AHT10 readings are labelled with the address of their mux and the
+        channel on it.
+            server - a JSONServer whose request count is exported
+        Timings and failures of every operation in sensors.stats are exported
+        too, including any added after this is built.
+        '''
+        self.sensors = sensors
+        self.server = server
+        
+        families = {}
+        self._readings = [] # (family header, [(sample prefix, snapshot key)]), samples grouped by family
+        for key in sensors.snapshot:
+            kind,_,idx = key.partition('_')
+            if kind in ('temperature', 'humidity') and idx.isdigit():
+                channel = sensors.aht_channels[int(idx)]
+                mux = sensors.bus.muxes[channel >> 3].address
+                name, labels = kind, f'{{sensor="aht10",mux="0x{mux:02x}",channel="{channel & 7}"}}'
+            else:
+                name, labels = key, ''
+            unit = Metrics.UNITS.get(sensors.report_unit(key))
+            family = f'{prefix}_{name}' if unit is None else f'{prefix}_{name}_{unit}'
+            if family not in families:
+                header = f'# TYPE {family} gauge\n'
+                if unit is not None:
+                    header += f'# UNIT {family} {unit}\n'
+                families[family] = []
+                self._readings.append((header.encode('utf-8'), families[family]))
+            families[family].append((f'{family}{labels} '.encode('utf-8'), key))
+        
+        self._age_header = (f'# TYPE {prefix}_sample_age_seconds gauge\n'
+                            f'# UNIT {prefix}_sample_age_seconds seconds\n').encode('utf-8')
+        self._ages = [(f'{prefix}_sample_age_seconds{{channel="{key}"}} '.encode('utf-8'), key) for key in sensors.snapshot]
+        self.prefix = prefix
+        self._seconds_header = (f'# TYPE {prefix}_operation_seconds summary\n'
+                                f'# UNIT {prefix}_operation_seconds seconds\n').encode('utf-8')
+        self._max_header = (f'# TYPE {prefix}_operation_max_seconds gauge\n'
+                            f'# UNIT {prefix}_operation_max_seconds seconds\n').encode('utf-8')
+        self._failures_header = f'# TYPE {prefix}_operation_failures counter\n'.encode('utf-8')
+        self._operations = [] # sample prefixes per Stats slot, extended as slots appear
+        self._requests = (f'# TYPE {prefix}_http_requests counter\n'
+                          f'{prefix}_http_requests_total ').encode('utf-8')
+        
+    def render(self):
+        '''
+        Returns the exposition as bytes.
+        '''
+        out = bytearray()
+        snapshot = self.sensors.snapshot
+        for header,samples in self._readings:
+            out.extend(header)
+            for prefix,key in samples:
+                value = snapshot[key]
+                if value is not None:
+                    out.extend(prefix)
+                    out.extend(str(value).encode('utf-8'))
+                    out.extend(b'\n')
+        
+        now = time.ticks_ms()
+        out.extend(self._age_header)
+        for prefix,key in self._ages:
+            stamp = self.sensors.stamps.get(key)
+            if stamp is not None:
+                out.extend(prefix)
+                out.extend(str(time.ticks_diff(now, stamp) / 1000).encode('utf-8'))
+                out.extend(b'\n')
+        
+        stats = self.sensors.stats
+        for name in stats.names[len(self._operations):]:
+            labels = f'{{operation="{name}"}} '
+            self._operations.append((
+                f'{self.prefix}_operation_seconds_count{labels}'.encode('utf-8'),
+                f'{self.prefix}_operation_seconds_sum{labels}'.encode('utf-8'),
+                f'{self.prefix}_operation_max_seconds{labels}'.encode('utf-8'),
+                f'{self.prefix}_operation_failures_total{labels}'.encode('utf-8')))
+        out.extend(self._seconds_header)
+        for i,(count,total,_,_) in enumerate(self._operations):
+            out.extend(count)
+            out.extend(str(stats.count[i]).encode('utf-8'))
+            out.extend(b'\n')
+            out.extend(total)
+            out.extend(str(stats.seconds(i)).encode('utf-8'))
+            out.extend(b'\n')
+        out.extend(self._max_header)
+        for i,(_,_,peak,_) in enumerate(self._operations):
+            out.extend(peak)
+            out.extend(str(stats.max_us[i] / 1000000).encode('utf-8'))
+            out.extend(b'\n')
+        out.extend(self._failures_header)
+        for i,(_,_,_,failures) in enumerate(self._operations):
+            out.extend(failures)
+            out.extend(str(stats.failures[i]).encode('utf-8'))
+            out.extend(b'\n')
+        
+        if self.server is not None:
+            out.extend(self._requests)
+            out.extend(str(self.server.requests).encode('utf-8'))
+            out.extend(b'\n')
+        out.extend(b'# EOF\n')
+        return out
@@ -1,72 +1,189 @@
 from machine import Pin, I2C
-from bmp180 import BMP180
-from i2cmux import I2CMUX
-from aht10 import AHT10
-from veml7700 import VEML7700
-from hx711 import HX711
+from bus import Bus
+from history import History
+from health import Health
+from stats import Stats, StatsI2C
+import json
 import time
 
 class Sensors:
+    _VEML, _BMP, _HX = 0, 1, 2 # health slots
     
-    def __init__(self, i2c, spi, weight_pins=None, bmp180=False, veml7700=False, aht10=0):
+    def __init__(self, i2c, spi, weight_pins=None, bmp180=False, veml7700=False, aht10=0, muxes=(0x70,), i2c_clock=None, i2c_freq=400000, cache=None):
         '''
         Abstraction of the sensor platform.
             i2c - a micropython I2C or SoftI2C object as the i2c bus
             spi - a micropython SPI or SoftSPI object as the spi bus
             weight_pins - a tuple of (clk,dat) gpio pin numbers fir weight sensor
+            aht10 - number of AHT10s on the first mux channels, or None to
+                find them on every channel of every mux
+            muxes - addresses of the I2C muxes, or None to discover them
+            i2c_clock - callable setting the i2c SCL frequency, which then runs
+                at i2c_freq except on channels with slower devices, see Bus
+            cache - file keeping the discovered muxes and AHT10 channels and
+                the BMP180 calibration between boots, None to always probe
+        AHT10s are numbered in mux address then channel order, and
+        self.aht_channels holds the bus channel of each.
+        Drivers are only imported for the sensors configured. Nothing here
+        waits for a conversion; the first readings come from sample().
+        A cached map is used when its muxes answer. Its AHT10s keep their
+        numbers even if one fails to initialize (its breaker retries it),
+        and only then, or with none cached, are the muxes searched again,
+        to add AHT10s found on new channels after the known ones. Delete the
+        cache after adding or moving AHT10s, or swapping a BMP180, whose
+        calibration is per chip.
+        Every sensor read and I2C transaction is timed in self.stats.
+        A sensor that keeps failing, including at init, is taken down in
+        self.health and served from its last known values (self.known)
+        without touching the bus, until a retry with exponential backoff
+        re-initializes it, so a replugged sensor comes back by itself.
         '''
-        self.i2c = i2c
+        self.stats = Stats(('veml7700', 'bmp180', 'hx711'))
+        self.health = Health(('veml7700', 'bmp180', 'hx711'))
+        self.known = {} # last good value per report key
+        self.i2c = StatsI2C(i2c, self.stats)
+        self.bus = Bus(self.i2c, () if muxes is None else muxes, clock=i2c_clock, freq=i2c_freq)
+        cached = Sensors._load(cache)
         
         init_log = []
         
         try:
-            self.switch = I2CMUX(self.i2c)
-            self.switch.set_state(bus=0)
+            if muxes is None:
+                self._find_muxes(cached)
+            self.bus.select(0)
         except:
             init_log.append('Could not init i2c switch')
         
         if bmp180:
+            from bmp180 import BMP180
+            self.bmp = BMP180(self.i2c, integer=True)
+            self.bus.attach(self.bmp.address)
             try:
-                self.bmp = BMP180(self.i2c)
-                self.bmp.config()
+                self._init_bmp(cached.get('bmp180'), False)
             except:
-                self.bmp = None
+                self.health.failed(Sensors._BMP, trip=True)
                 init_log.append('Failed to initialize bmp180 barometer')
         else:
             self.bmp = None        
         
         if veml7700:
+            from veml7700 import VEML7700
+            self.veml = VEML7700(self.i2c)
+            self.bus.attach(self.veml.address)
             try:
-                self.veml = VEML7700(self.i2c)
-                self.veml.config()
+                self._init_veml()
             except:
-                self.bmp = None
+                self.health.failed(Sensors._VEML, trip=True)
                 init_log.append('Failed to initialize veml7700 ambient light sensor')
         else:
             self.veml = None
             
         self.ahts = []
-        for i in range(aht10):
-            try:
-                self.switch.set_state(bus=i)
-                aht = AHT10(self.i2c)
-                aht.config()
-                self.ahts.append(aht)
-            except:
-                init_log.append(f'Failed to initialize aht10-{i} temperature/humidity sensor')
-                self.ahts.append(None)
+        self.aht_channels = []
+        self._aht_slots = []
+        self._aht_health = []
+        if aht10 is None:
+            channels = cached.get('aht_channels', []) if 'muxes' in cached else []
+            if not self._add_ahts(channels, init_log) or len(channels) == 0:
+                try:
+                    found = self.bus.find(0x38)
+                except:
+                    found = []
+                    init_log.append('Could not search the i2c switches for aht10 sensors')
+                self._add_ahts([c for c in found if c not in self.aht_channels], init_log)
+        else:
+            self._add_ahts(range(aht10), init_log)
         
         if weight_pins is not None:
             try:
+                from hx711 import HX711
                 assert len(weight_pins) == 2, 'weight_pins must specify (clk,dat) lines for hx711'
                 self.weight = HX711(clk=weight_pins[0],dat=weight_pins[1])
             except:
-                self.bmp = None
+                self.weight = None
                 init_log.append('Failed to initialize hx711 weight sensor')
         else:
             self.weight = None
 
         self.init_issues = init_log
+        
+        if cache is not None:
+            self._save(cache, cached, muxes is None, aht10 is None)
+        
+        self.snapshot = {}
+        self.stamps = {}
+        self.tasks = []
+        self._sampling = False # running a sampling task
+        self._triggered = None # AHT10s the sampler is waiting on
+        self.history = None
+        self.log = None
+    
+    @staticmethod
+    def _load(cache):
+        if cache is None:
+            return {}
+        try:
+            with open(cache) as f:
+                return json.load(f)
+        except:
+            return {} # none yet, or unreadable
+    
+    def _save(self, cache, cached, muxes, ahts):
+        '''
+        Write what was found to the cache file, if it changed.
+        '''
+        found = {}
+        if muxes:
+            found['muxes'] = [mux.address for mux in self.bus.muxes]
+        if ahts:
+            found['aht_channels'] = self.aht_channels
+        if self.bmp is not None and self.health.ok(Sensors._BMP):
+            found['bmp180'] = self.bmp.calibration()
+        if found == cached:
+            return
+        try:
+            with open(cache, 'w') as f:
+                json.dump(found, f)
+        except:
+            pass # booting again just probes again
+    
+    def _find_muxes(self, cached):
+        '''
+        Use the cached muxes if they all take a write, else discover them.
+        '''
+        addresses = cached.get('muxes')
+        if addresses is not None:
+            try:
+                self.bus.set_muxes(addresses)
+                self.bus.set_masks(bytearray(len(addresses)))
+                return
+            except:
+                cached.pop('muxes')
+                cached.pop('aht_channels', None)
+        self.bus.discover()
+    
+    def _add_ahts(self, channels, init_log):
+        '''
+        Create and initialize an AHT10 on each of channels, numbered after
+        those already added. Returns True if all of them initialized.
+        '''
+        from aht10 import AHT10
+        ok = True
+        for channel in channels:
+            i = len(self.ahts)
+            self.aht_channels.append(channel)
+            self._aht_slots.append(self.stats.add(f'aht10_{i}'))
+            self._aht_health.append(self.health.add(f'aht10_{i}'))
+            aht = AHT10(self.i2c)
+            self.bus.attach(aht.address, channel)
+            self.ahts.append(aht)
+            try:
+                self._init_aht(i)
+            except:
+                ok = False
+                self.health.failed(self._aht_health[i], trip=True)
+                init_log.append(f'Failed to initialize aht10-{i} temperature/humidity sensor')
+        return ok
             
     def __str__(self):
         info = 'Sensor readings:'
@@ -91,54 +208,422 @@ class Sensors:
         return unit
     
     def report(self):
-        lux = self.read_lux()
-        ext_temp,ext_press = self.read_temp_pressure()
+        with self.bus:
+            # the light and pressure reads share channel 0 with the triggered
+            # AHT10s, so they run during the conversion
+            indexes = range(len(self.ahts))
+            triggered = self._trigger_temp_humid(indexes)
+            lux = self.read_lux()
+            ext_temp,ext_press = self.read_temp_pressure()
+            if triggered is not None:
+                temp_humid = self._collect_temp_humid(indexes, triggered)
+            else:
+                temp_humid = self.read_all_temp_humid(pipelined=False, indexes=indexes)
         
         report = {
             'ambient_lux': lux,
             'ext_temperature': ext_temp,
             'ext_pressure': ext_press
         }
-        for i,(temp,humid) in enumerate(self.read_all_temp_humid()):
+        for i,(temp,humid) in enumerate(temp_humid):
             report[f'temperature_{i}'] = temp
             report[f'humidity_{i}'] = humid
             
         report['weight'] = self.read_weight()
         return report        
     
+    def read(self, fields, max_age=None):
+        '''
+        Read only the sensors needed for the given report keys ('lux' is
+        accepted for 'ambient_lux'). Returns {field: value}.
+        Fields sampled no more than max_age seconds ago are taken from the
+        snapshot instead (see latest()), so only stale ones block on the
+        hardware.
+        Raises ValueError for an unknown field before touching any sensor.
+        '''
+        for field in fields:
+            if field in ('lux', 'ambient_lux', 'ext_temperature', 'ext_pressure', 'weight'):
+                continue
+            kind,_,idx = field.partition('_')
+            if kind in ('temperature', 'humidity') and idx.isdigit() and int(idx) < len(self.ahts):
+                continue
+            raise ValueError(f'Unknown field {field}')
+        
+        results = {}
+        stale = []
+        now = time.ticks_ms()
+        for field in fields:
+            key = 'ambient_lux' if field == 'lux' else field
+            stamp = self.stamps.get(key)
+            if max_age is not None and stamp is not None and time.ticks_diff(now, stamp) <= max_age * 1000:
+                results[field] = self.snapshot[key]
+            else:
+                results[field] = None # read below, in the order asked for
+                stale.append(field)
+        
+        indexes = []
+        for field in stale:
+            kind,_,idx = field.partition('_')
+            if kind in ('temperature', 'humidity') and int(idx) not in indexes:
+                indexes.append(int(idx))
+        
+        temp_humid = {}
+        if len(indexes) > 0:
+            for idx,result in zip(indexes, self.read_all_temp_humid(indexes=indexes)):
+                temp_humid[idx] = result
+        temp_pressure = None
+        for field in stale:
+            if field in ('lux', 'ambient_lux'):
+                results[field] = self.read_lux()
+            elif field == 'weight':
+                results[field] = self.read_weight()
+            elif field.startswith('ext_'):
+                if temp_pressure is None:
+                    temp_pressure = self.read_temp_pressure()
+                results[field] = temp_pressure[0 if field == 'ext_temperature' else 1]
+            else:
+                kind,_,idx = field.partition('_')
+                results[field] = temp_humid[int(idx)][0 if kind == 'temperature' else 1]
+        return results
+    
+    def schedule(self, lux=1000, barometer=5000, temp_humid=30000, weight=10000, history=240, log=None):
+        '''
+        Configure background sampling of each sensor at its own period (ms).
+        A period of None disables sampling for that sensor. sample() must be
+        called regularly (e.g. from the server idle hook) to run due reads.
+        The barometer is stepped through its conversions without blocking,
+        so a new pair lands every period plus its ~31 ms of conversions.
+        Every sampled value is also kept in a History of the given number of
+        samples per channel (None disables the history), and appended to log
+        if a FlashLog is given.
+        '''
+        self.tasks = []
+        self.snapshot = {}
+        self.stamps = {}
+        if lux and self.veml is not None:
+            self.snapshot['ambient_lux'] = None
+            self.tasks.append([lux, time.ticks_ms(), self._sample_lux, 'lux'])
+        if barometer and self.bmp is not None:
+            self.snapshot['ext_temperature'] = None
+            self.snapshot['ext_pressure'] = None
+            self.tasks.append([barometer, time.ticks_ms(), self._sample_temp_pressure, 'barometer'])
+        if temp_humid and len(self.ahts) > 0:
+            for i in range(len(self.ahts)):
+                self.snapshot[f'temperature_{i}'] = None
+                self.snapshot[f'humidity_{i}'] = None
+            self.tasks.append([temp_humid, time.ticks_ms(), self._sample_all_temp_humid, 'temp_humid'])
+        if weight and self.weight is not None:
+            self.snapshot['weight'] = None
+            self.tasks.append([weight, time.ticks_ms(), self._sample_weight, 'weight'])
+        if history:
+            self.history = History(history)
+            for key in self.snapshot:
+                self.history.add_channel(key)
+        else:
+            self.history = None
+        self.log = log
+    
+    def sample(self):
+        '''
+        Run the most overdue sampling task, if any is due. A task may return
+        the ms until it needs to run again instead of waiting for its period.
+        Returns True if a sensor was read.
+        '''
+        if self.weight is not None:
+            self.weight.poll() # restarts a stalled background queue
+        now = time.ticks_ms()
+        due = None
+        for task in self.tasks:
+            if time.ticks_diff(now, task[1]) >= 0:
+                if due is None or time.ticks_diff(due[1], task[1]) > 0:
+                    due = task
+        if due is None:
+            return False
+        due[1] = time.ticks_add(now, due[0])
+        self._sampling = True
+        try:
+            wait = due[2]()
+        finally:
+            self._sampling = False
+        if wait is not None:
+            due[1] = time.ticks_add(time.ticks_ms(), wait)
+        return True
+    
+    def latest(self, *keys):
+        '''
+        Readings from the sampled snapshot without touching the hardware.
+        The age of each value in seconds is included under 'age'.
+        All sampled keys are returned if none are given.
+        '''
+        now = time.ticks_ms()
+        if len(keys) == 0:
+            keys = self.snapshot.keys()
+        values = {}
+        ages = {}
+        for key in keys:
+            values[key] = self.snapshot.get(key)
+            stamp = self.stamps.get(key)
+            ages[key] = None if stamp is None else time.ticks_diff(now, stamp) / 1000
+        values['age'] = ages
+        return values
+    
+    def _store(self, key, value):
+        self.snapshot[key] = value
+        self.stamps[key] = time.ticks_ms()
+        if self.history is not None:
+            self.history.record(key, value)
+        if self.log is not None:
+            self.log.append(key, value)
+    
+    # the sampling tasks only store fresh readings, the snapshot keeps the
+    # last good value and its age while a sensor fails, and return the ms
+    # to wait rather than block on a conversion
+    
+    def _sample_lux(self):
+        if not self._ready(Sensors._VEML, self._init_veml):
+            return
+        if self.veml.wait_ms() > 0:
+            return self.veml.wait_ms() # first integration after config
+        lux = self.read_lux()
+        if self.health.ok(Sensors._VEML):
+            self._store('ambient_lux', lux)
+    
+    def _sample_temp_pressure(self):
+        if not self._ready(Sensors._BMP, self._init_bmp, None, False):
+            return
+        start = time.ticks_us()
+        try:
+            with self.bus:
+                self.bus.select(0, exclusive=False)
+                wait = self.bmp.step()
+            if wait is not None:
+                self.stats.record('bmp180', start)
+                return wait # conversion running
+            temp,pressure,_ = self.bmp.latest()
+        except Exception as e:
+            self.stats.record('bmp180', start, e)
+            self.health.failed(Sensors._BMP)
+            return
+        self.stats.record('bmp180', start)
+        self.health.succeeded(Sensors._BMP)
+        pressure = pressure/1000.0
+        self.known['ext_temperature'] = temp
+        self.known['ext_pressure'] = pressure
+        self._store('ext_temperature', temp)
+        self._store('ext_pressure', pressure)
+    
+    def _sample_all_temp_humid(self):
+        # triggers, then collects when run again after the conversion time
+        indexes = range(len(self.ahts))
+        if self._triggered is None:
+            with self.bus:
+                triggered = self._trigger_temp_humid(indexes)
+            if triggered is None:
+                results = self.read_all_temp_humid(pipelined=False)
+            elif len(triggered) > 0:
+                self._triggered = triggered
+                return self.ahts[triggered[0]].CONVERSION_MS
+            else:
+                results = self._collect_temp_humid(indexes, triggered)
+        else:
+            with self.bus:
+                results = self._collect_temp_humid(indexes, self._triggered)
+            self._triggered = None
+        for i,(temp,humid) in enumerate(results):
+            if self.health.ok(self._aht_health[i]):
+                self._store(f'temperature_{i}', temp)
+                self._store(f'humidity_{i}', humid)
+    
+    def _sample_weight(self):
+        hx = self.weight
+        if hx is not None and hx.running and hx.seq == 0 and time.ticks_diff(time.ticks_ms(), hx.stamp) < 1000:
+            return 50 # settling after start()
+        weight = self.read_weight()
+        if self.health.ok(Sensors._HX):
+            self._store('weight', weight)
+    
+    def _ready(self, slot, init=None, *args):
+        '''
+        Whether the sensor in health slot may be read now. One that is down
+        is skipped until its backoff has passed, then init(*args) is run
+        first in case it was replugged. If that works the sensor is probed
+        (half-open) until a read tells whether it is back, so a read that
+        takes several calls (a conversion to wait for) does not
+        re-initialize it every time. While sampling tasks are scheduled,
+        only they retry, so requests never wait on a dead sensor.
+        '''
+        if not self.health.down(slot) or self.health.probing[slot]:
+            return True
+        if not self.health.due(slot) or (self.tasks and not self._sampling):
+            return False
+        if init is not None:
+            try:
+                init(*args)
+            except:
+                self.health.failed(slot)
+                return False
+            self.health.probe(slot)
+        return True
+    
+    def _init_bmp(self, calibration=None, measure=True):
+        with self.bus:
+            self.bus.select(0, exclusive=False)
+            self.bmp.config(calibration, measure)
+    
+    def _init_veml(self):
+        with self.bus:
+            self.bus.select(0, exclusive=False)
+            self.veml.config(auto=True)
+    
+    def _init_aht(self, idx):
+        with self.bus:
+            self.bus.select(self.aht_channels[idx])
+            self.ahts[idx].config()
+    
     def read_weight(self):
+        if not self._ready(Sensors._HX):
+            return self.known.get('weight')
+        start = time.ticks_us()
         try:
-            return self.weight.weight()
-        except:
-            return None
+            weight = self.weight.weight()
+        except Exception as e:
+            self.stats.record('hx711', start, e)
+            self.health.failed(Sensors._HX)
+            return self.known.get('weight')
+        self.stats.record('hx711', start)
+        self.health.succeeded(Sensors._HX)
+        self.known['weight'] = weight
+        return weight
     
     def read_lux(self):
+        if not self._ready(Sensors._VEML, self._init_veml):
+            return self.known.get('ambient_lux')
+        start = time.ticks_us()
         try:
-            self.switch.set_state(bus=0)
-            lux = self.veml.lux()
-            return lux
-        except:
-            return None
+            with self.bus:
+                self.bus.select(0, exclusive=False)
+                lux = self.veml.lux()
+        except Exception as e:
+            self.stats.record('veml7700', start, e)
+            self.health.failed(Sensors._VEML)
+            return self.known.get('ambient_lux')
+        self.stats.record('veml7700', start)
+        self.health.succeeded(Sensors._VEML)
+        self.known['ambient_lux'] = lux
+        return lux
             
     def read_temp_pressure(self):
+        if not self._ready(Sensors._BMP, self._init_bmp, None, False):
+            return self.known.get('ext_temperature'), self.known.get('ext_pressure')
+        start = time.ticks_us()
         try:
-            self.switch.set_state(bus=0)
-            temp = self.bmp.temperature()
-            pressure = self.bmp.pressure(read=False)
-            return temp, pressure/1000.0
-        except:
-            return None, None
+            with self.bus:
+                self.bus.select(0, exclusive=False)
+                temp = self.bmp.temperature()
+            pressure = self.bmp.pressure(read=False)/1000.0
+        except Exception as e:
+            self.stats.record('bmp180', start, e)
+            self.health.failed(Sensors._BMP)
+            return self.known.get('ext_temperature'), self.known.get('ext_pressure')
+        self.stats.record('bmp180', start)
+        self.health.succeeded(Sensors._BMP)
+        self.known['ext_temperature'] = temp
+        self.known['ext_pressure'] = pressure
+        return temp, pressure
+    
+    def _known_temp_humid(self, idx):
+        return self.known.get(f'temperature_{idx}'), self.known.get(f'humidity_{idx}')
+    
+    def _good_temp_humid(self, idx, result):
+        self.health.succeeded(self._aht_health[idx])
+        self.known[f'temperature_{idx}'] = result[0]
+        self.known[f'humidity_{idx}'] = result[1]
         
     def read_temp_humid(self, idx):
+        if not self._ready(self._aht_health[idx], self._init_aht, idx):
+            return self._known_temp_humid(idx)
+        start = time.ticks_us()
         try:
-            self.switch.set_state(bus=idx)
-            return self.ahts[idx].both()
-        except:
-            return (None,None)
+            with self.bus:
+                self.bus.select(self.aht_channels[idx])
+                result = self.ahts[idx].both()
+        except Exception as e:
+            self.stats.record_slot(self._aht_slots[idx], start, e)
+            self.health.failed(self._aht_health[idx])
+            return self._known_temp_humid(idx)
+        self.stats.record_slot(self._aht_slots[idx], start)
+        self._good_temp_humid(idx, result)
+        return result
             
-    def read_all_temp_humid(self):
-        results = []
-        for i in range(len(self.ahts)):
-            result = self.read_temp_humid(i)
-            results.append(result)
-        return results
\ No newline at end of file
+    def read_all_temp_humid(self, pipelined=True, indexes=None):
+        '''
+        Read every AHT10, or only those in indexes. When pipelined, all
+        sensors are triggered together by enabling their mux channels at once,
+        then read back one channel at a time, so the total cost is close to a
+        single conversion. Each sensor's time is that of its read back, so
+        the first one includes the wait for the conversion.
+        '''
+        if indexes is None:
+            indexes = range(len(self.ahts))
+        with self.bus:
+            if pipelined:
+                triggered = self._trigger_temp_humid(indexes)
+                if triggered is not None:
+                    return self._collect_temp_humid(indexes, triggered)
+            results = []
+            for i in indexes:
+                result = self.read_temp_humid(i)
+                results.append(result)
+            return results
+    
+    def _trigger_temp_humid(self, indexes):
+        '''
+        Start a conversion on the AHT10s in indexes that are not down with
+        one write, leaving their channels enabled on every mux at once.
+        Returns the indexes triggered, or None if the write failed.
+        '''
+        triggered = []
+        masks = bytearray(len(self.bus.muxes))
+        for i in indexes:
+            if self._ready(self._aht_health[i], self._init_aht, i):
+                triggered.append(i)
+                channel = self.aht_channels[i]
+                masks[channel >> 3] |= 1 << (channel & 7)
+        if len(triggered) == 0:
+            return triggered
+        try:
+            self.bus.set_masks(masks)
+            aht = self.ahts[triggered[0]]
+            aht.trigger() # every enabled channel sees this write
+        except:
+            return None
+        self._collect_by = time.ticks_add(time.ticks_ms(), aht.CONVERSION_MS*3//2)
+        return triggered
+    
+    def _collect_temp_humid(self, indexes, triggered):
+        '''
+        Read back the triggered AHT10s in channel order, so each channel is
+        selected once. Results are in the order of indexes, with the last
+        known values of those not triggered. All of them converted at once,
+        so one still busy well after the conversion time has failed and
+        is not waited for.
+        '''
+        by_channel = {}
+        for i in triggered:
+            by_channel[self.aht_channels[i]] = i
+        results = {}
+        for channel in self.bus.ordered(by_channel):
+            i = by_channel[channel]
+            start = time.ticks_us()
+            try:
+                self.bus.select(channel)
+                aht = self.ahts[i]
+                aht.collect(max(time.ticks_diff(self._collect_by, time.ticks_ms()), aht.POLL_MS))
+                results[i] = aht.both(read=False)
+            except Exception as e:
+                self.stats.record_slot(self._aht_slots[i], start, e)
+                self.health.failed(self._aht_health[i])
+                continue
+            self.stats.record_slot(self._aht_slots[i], start)
+            self._good_temp_humid(i, results[i])
+        return [results[i] if i in results else self._known_temp_humid(i) for i in indexes]
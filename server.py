@@ -1,28 +1,135 @@
 import socket
-import machine
 import json
+import time
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+def _ticks_ms():
+    '''
+    time.ticks_ms() on MicroPython, None on CPython, which has no boot to
+    time from.
+    '''
+    ticks = getattr(time, 'ticks_ms', None)
+    return None if ticks is None else ticks()
+
+def unquote(text):
+    '''
+    Decode %XX escapes and '+' in a URL component.
+    '''
+    text = text.replace('+', ' ')
+    if '%' not in text:
+        return text
+    parts = text.split('%')
+    data = bytearray(parts[0].encode('utf-8'))
+    for part in parts[1:]:
+        try:
+            data.append(int(part[:2], 16))
+            data.extend(part[2:].encode('utf-8'))
+        except ValueError:
+            data.extend(b'%')
+            data.extend(part.encode('utf-8'))
+    return bytes(data).decode('utf-8')
+
+def parse_query(query):
+    '''
+    Decode a URL query string into a dict of parameters.
+    '''
+    params = {}
+    for pair in query.split('&'):
+        if len(pair) == 0:
+            continue
+        key,_,value = pair.partition('=')
+        params[unquote(key)] = unquote(value)
+    return params
 
 class Request:
     
-    def __init__(self, server, conn, target, headers, body):
+    def __init__(self, server, conn, target, headers, body, query=None, keep_alive=False):
         self.server = server
         self.conn = conn
         self.target = target
         self.headers = headers
         self.body = body
+        self.query = {} if query is None else query
+        self.keep_alive = keep_alive
         
     def reply(self, **kwargs):
-        self.server._reply(self.conn, **kwargs)
+        self.server._reply(self.conn, keep_alive=self.keep_alive, **kwargs)
+        
+    def stream(self, iterable, key='records', **kwargs):
+        '''
+        Reply with the items of iterable as a JSON list under key, sent
+        incrementally with chunked transfer encoding. Other kwargs are
+        included in the reply object as with reply().
+        '''
+        self.server._stream(self.conn, iterable, key, keep_alive=self.keep_alive, **kwargs)
+        
+    def send(self, data, content_type='text/plain'):
+        '''
+        Reply with a raw (non-JSON) body of bytes.
+        '''
+        self.server._send(self.conn, data, content_type, keep_alive=self.keep_alive)
         
     def error(self, msg, code=400):
-        self.server._error(self.conn, msg, code=code)
+        self.server._error(self.conn, msg, code=code, keep_alive=self.keep_alive)
+
+class StreamConn:
+    '''
+    Adapts an asyncio StreamWriter to the socket calls used by JSONServer,
+    so handlers work unchanged in both serving modes. Data is buffered in the
+    writer and flushed once the handler returns.
+    '''
+    
+    def __init__(self, writer):
+        self.writer = writer
+        self.chunks = None # deferred streaming reply, see JSONServer._stream
+        
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        elif isinstance(data, memoryview):
+            data = bytes(data) # the server reuses the memory behind its views
+        self.writer.write(data)
+        
+    def sendall(self, data):
+        self.send(data)
+        
+    def close(self):
+        pass # closed by the server once the connection is done
 
 class JSONServer:
 
-    def __init__(self, addr='', port=80, backlog=5):
+    def __init__(self, addr='', port=80, backlog=5, verbose=True, chunk_size=512,
+                 timeout=5, keep_alive=2, max_requests=16):
+        '''
+        Minimal HTTP/1.1 server replying with JSON.
+            timeout - seconds allowed for each read while receiving a request
+            keep_alive - seconds a persistent connection may idle between
+                requests (0 closes every connection after one reply), only
+                with serve_async()
+            max_requests - requests served on one connection before closing it
+        '''
         self.addr = addr
         self.port = port
         self.backlog = backlog
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.max_requests = max_requests
+        self.verbose = verbose
+        self.chunk_size = chunk_size
+        # responses are assembled in one reusable buffer and sent in one call
+        self._out = bytearray(512)
+        self._view = memoryview(self._out)
+        self._status_lines = {}
+        self._server = b'Server: BeeLogger-ESP32\r\n'
+        self._headers = self._server + b'Content-Type: text/json\r\n'
+        self._close = b'Connection: close\r\n\r\n'
+        self._keep = b'Connection: keep-alive\r\n\r\n'
+        self.requests = 0 # served since boot
+        self.listening_ms = None # ticks_ms() when the server started listening
+        self.first_request_ms = None # ticks_ms() when the first request was dispatched
         self._endpoints = {}
         self.add_endpoint('GET','/hello',lambda req: req.reply(msg='greetings'))
         self.add_endpoint('POST','/hello',lambda req: req.reply(msg='post-greetings'))
@@ -36,71 +143,280 @@ class JSONServer:
         else:
             self._endpoints[verb][endpoint] = handler
         
-    def _reply(self, conn, code=200, status='OK', **payload):
+    def _status_line(self, code, status):
+        line = self._status_lines.get((code, status))
+        if line is None:
+            line = f'HTTP/1.1 {code} {status}\r\n'.encode('utf-8')
+            self._status_lines[(code, status)] = line
+        return line
+    
+    def _put(self, n, data):
+        '''
+        Copy data into the response buffer at offset n, returns the new end.
+        '''
+        end = n + len(data)
+        if end > len(self._out):
+            out = bytearray(2 * end)
+            out[:n] = self._out[:n]
+            self._out = out
+            self._view = memoryview(out)
+        self._out[n:end] = data
+        return end
+        
+    def _reply(self, conn, code=200, status='OK', keep_alive=False, **payload):
+        payload['status'] = status
+        data = json.dumps(payload).encode('utf-8')
+        n = self._put(0, self._status_line(code, status))
+        n = self._put(n, self._headers)
+        n = self._put(n, f'Content-Length: {len(data) + 1}\r\n'.encode('utf-8'))
+        n = self._put(n, self._keep if keep_alive else self._close)
+        n = self._put(n, data)
+        n = self._put(n, b'\n')
+        conn.sendall(self._view[:n])
+        
+    def _send(self, conn, data, content_type, code=200, status='OK', keep_alive=False):
+        n = self._put(0, self._status_line(code, status))
+        n = self._put(n, self._server)
+        n = self._put(n, f'Content-Type: {content_type}\r\nContent-Length: {len(data)}\r\n'.encode('utf-8'))
+        n = self._put(n, self._keep if keep_alive else self._close)
+        n = self._put(n, data)
+        conn.sendall(self._view[:n])
+        
+    def _stream(self, conn, iterable, key, code=200, status='OK', keep_alive=False, **payload):
         payload['status'] = status
-        data = f'{json.dumps(payload)}\n'
-        conn.send(f'HTTP/1.1 {code} {status}\r\n')
-        conn.send('Server: BeeLogger-ESP32\r\n')
-        conn.send('Content-Type: text/json\r\n')
-        conn.send(f'Content-Length: {len(data)}\r\n')
-        conn.send('Connection: close\r\n\r\n')
-        conn.sendall(data)
-        conn.close()
-        
-    def _error(self, conn, msg, code=400):
+        n = self._put(0, self._status_line(code, status))
+        n = self._put(n, self._headers)
+        n = self._put(n, b'Transfer-Encoding: chunked\r\n')
+        n = self._put(n, self._keep if keep_alive else self._close)
+        conn.sendall(self._view[:n])
+        head = json.dumps(payload)
+        chunks = self._chunks(iterable, f'{head[:-1]}, {json.dumps(key)}: [', ']}\n')
+        if isinstance(conn, StreamConn):
+            conn.chunks = chunks # written by the event loop between drains
+            return
+        try:
+            for chunk in chunks:
+                conn.sendall(chunk)
+        except Exception as e:
+            # the status line is sent, so the handler must not reply again;
+            # serve() closes the connection before the last chunk, which
+            # tells the client the body is incomplete
+            print('Stream Error')
+            print(e)
+    
+    def _chunks(self, iterable, head, tail):
+        '''
+        Yields HTTP chunks of the JSON encoded items of iterable between head
+        and tail, each holding at most about chunk_size bytes of payload.
+        '''
+        buf = bytearray(head.encode('utf-8'))
+        sep = b''
+        for item in iterable:
+            data = json.dumps(item).encode('utf-8')
+            if len(buf) + len(sep) + len(data) > self.chunk_size and len(buf) > 0:
+                yield self._chunk(buf)
+                buf = bytearray()
+            buf.extend(sep)
+            buf.extend(data)
+            sep = b','
+        buf.extend(tail.encode('utf-8'))
+        yield self._chunk(buf)
+        yield b'0\r\n\r\n'
+    
+    def _chunk(self, data):
+        chunk = bytearray(f'{len(data):x}\r\n'.encode('utf-8'))
+        chunk.extend(data)
+        chunk.extend(b'\r\n')
+        return chunk
+        
+    def _error(self, conn, msg, code=400, keep_alive=False):
         print(msg)
         try:
-            self._reply(conn, code=400, status='BAD', msg=msg)
+            self._reply(conn, code=400, status='BAD', keep_alive=keep_alive, msg=msg)
         except:
             pass
+    
+    def _parse_request_line(self, request):
+        '''
+        Returns (verb, target) from an HTTP request line or None if unsupported.
+        '''
+        if self.verbose: print('>>',request)
+        request = request.decode('utf-8')
+        parts = request[:-2].split(' ')
+        if len(parts) != 3:
+            print('Malformed HTTP/1.1 request')
+            return None
+            
+        verb,target,version = parts
+        if version != 'HTTP/1.1':
+            print(f'Unknown protocol version {version}')
+            return None
+        
+        return verb.upper(), target
+    
+    def _parse_header(self, header, headers):
+        if self.verbose: print('>>',header)
+        header,payload = header.decode('utf-8').split(':', 1)
+        headers[header] = payload.strip()
+    
+    def _persist(self, headers, served):
+        '''
+        True if the connection stays open after this reply: HTTP/1.1
+        connections persist unless the client asks to close.
+        '''
+        if self.keep_alive <= 0 or served >= self.max_requests:
+            return False
+        for name in headers: # header names are case-insensitive
+            if name.lower() == 'connection':
+                return headers[name].strip().lower() != 'close'
+        return True
+    
+    def _dispatch(self, conn, verb, target, headers, body, keep_alive=False):
+        if self.verbose: print('>>',body)
+        self.requests += 1
+        if self.first_request_ms is None:
+            self.first_request_ms = _ticks_ms()
+        target,_,query = target.partition('?')
+        if verb in self._endpoints:
+            verb_handlers = self._endpoints[verb]
+            if target in verb_handlers:
+                verb_handlers[target](Request(self, conn, target, headers, body, parse_query(query), keep_alive))
+                return
+            
+        self._reply(conn, code='404', status='NOTFOUND', keep_alive=keep_alive, verb=verb, target=target, **headers)
 
-    def serve(self):
+    def serve(self, idle=None, idle_ms=100):
+        '''
+        Serve requests forever. If idle is given it is called between requests
+        and at least every idle_ms while no client is connecting.
+        Connections are closed after one reply, as a client idling on a
+        persistent one would hold up every other client and idle here.
+        serve_async() keeps them open.
+        '''
     
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((self.addr, self.port))
         s.listen(self.backlog)
+        self.listening_ms = _ticks_ms()
+        if idle is not None:
+            s.settimeout(idle_ms / 1000)
         
         while True:
+            if idle is not None:
+                try:
+                    idle()
+                except Exception as e:
+                    print('Idle Error')
+                    print(e)
             try:
                 conn, addr = s.accept()
-                print(f'Serving {addr}')
+            except OSError:
+                continue # accept timed out, back to idle work
+            stream = None
+            try:
+                conn.settimeout(self.timeout)
+                stream = conn.makefile('rb') # the socket itself on MicroPython
+                if self.verbose: print(f'Serving {addr}')
                 
-                request = conn.readline()
-                print('>>',request)
-                request = request.decode('utf-8')
-                parts = request[:-2].split(' ')
-                if len(parts) != 3:
-                    print('Malformed HTTP/1.1 request')
-                    continue
-                    
-                verb,target,version = parts
-                if version != 'HTTP/1.1':
-                    print(f'Unknown protocol version {version}')
+                request = self._parse_request_line(stream.readline())
+                if request is None:
                     continue
+                verb,target = request
                     
                 headers = {}
-                while (header:=conn.readline()) != b'\r\n':
-                    print('>>',header)
-                    header,payload = header.decode('utf-8').split(':')
-                    headers[header] = payload.strip()
+                while (header:=stream.readline()) != b'\r\n':
+                    self._parse_header(header, headers)
                     
                 if 'Content-Length' in headers:
                     total_size = int(headers['Content-Length'])
                     body = b''
-                    while len(data) < total_size:
-                        body += conn.read(total_size-len(data))
+                    while len(body) < total_size:
+                        body += stream.read(total_size-len(body))
                 else:
                     body = None
-                print('>>',body)
-                    
-                verb = verb.upper()
-                if verb in self._endpoints:
-                    verb_handlers = self._endpoints[verb]
-                    if target in verb_handlers:
-                        verb_handlers[target](Request(self, conn, target, headers, body))
-                        continue
                     
-                self._reply(conn, code='404', status='NOTFOUND', verb=verb, target=target, **headers)
+                self._dispatch(conn, verb, target, headers, body)
+            except OSError:
+                pass # timed out or reset, drop the connection
             except Exception as e:
                 print('Internal Error')
                 print(e)
+            finally:
+                if stream is not None:
+                    stream.close()
+                conn.close()
+    
+    async def _readline(self, reader):
+        line = await asyncio.wait_for(reader.readline(), self.timeout)
+        if not line:
+            raise EOFError('Connection closed by client')
+        return line
+    
+    async def _serve_conn(self, reader, writer):
+        conn = StreamConn(writer)
+        try:
+            served = 0
+            while served < self.max_requests:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), self.timeout if served == 0 else self.keep_alive)
+                except asyncio.TimeoutError:
+                    if served == 0:
+                        print('Client timed out')
+                    break
+                if not line:
+                    break # client closed the connection
+                request = self._parse_request_line(line)
+                if request is None:
+                    break
+                verb,target = request
+                
+                headers = {}
+                while (header:=await self._readline(reader)) != b'\r\n':
+                    self._parse_header(header, headers)
+                
+                if 'Content-Length' in headers:
+                    total_size = int(headers['Content-Length'])
+                    body = await asyncio.wait_for(reader.readexactly(total_size), self.timeout)
+                else:
+                    body = None
+                
+                served += 1
+                keep_alive = self._persist(headers, served)
+                self._dispatch(conn, verb, target, headers, body, keep_alive)
+                await writer.drain()
+                if conn.chunks is not None:
+                    for chunk in conn.chunks:
+                        writer.write(chunk)
+                        await writer.drain()
+                    conn.chunks = None
+                if not keep_alive:
+                    break
+        except asyncio.TimeoutError:
+            print('Client timed out')
+        except Exception as e:
+            print('Internal Error')
+            print(e)
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except Exception:
+            pass
+    
+    async def serve_async(self, idle=None, idle_ms=100):
+        '''
+        Serve requests forever on the asyncio event loop, handling several
+        connections at once. If idle is given it is called every idle_ms as a
+        task on the same event loop.
+        '''
+        await asyncio.start_server(self._serve_conn, self.addr or '0.0.0.0', self.port, backlog=self.backlog)
+        self.listening_ms = _ticks_ms()
+        
+        while True:
+            if idle is not None:
+                try:
+                    idle()
+                except Exception as e:
+                    print('Idle Error')
+                    print(e)
+            await asyncio.sleep(idle_ms / 1000)
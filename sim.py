@@ -0,0 +1,894 @@
+'''
+Hardware-free simulation of the BeeLogger board so the firmware runs
+unchanged on CPython. install() registers stand-ins for the MicroPython
+modules the firmware imports (machine, micropython, framebuf, network,
+webrepl, ustruct, uasyncio) plus the MicroPython extensions to time, backed
+by a Board of register-level device models with realistic conversion
+latencies and injectable faults.
+
+    python3 sim.py [--flash DIR]    # run main.py against the simulated board
+
+Other scripts call sim.install() before importing any firmware module and
+use the returned Board to change readings, inject faults or read counters.
+'''
+import asyncio
+import os
+import random
+import runpy
+import struct
+import sys
+import threading
+import time
+import traceback
+import types
+
+BOARD = None # the Board the simulated machine module talks to
+
+def _now():
+    return time.monotonic()
+
+# ---------------------------------------------------------------------------
+# time
+
+_T0 = time.monotonic()
+
+def ticks_ms():
+    return int((time.monotonic() - _T0) * 1000)
+
+def ticks_us():
+    return int((time.monotonic() - _T0) * 1000000)
+
+def ticks_diff(a, b):
+    return a - b
+
+def ticks_add(a, b):
+    return a + b
+
+def sleep_ms(ms):
+    time.sleep(ms / 1000)
+
+def sleep_us(us):
+    time.sleep(us / 1000000)
+
+# ---------------------------------------------------------------------------
+# I2C devices
+
+class Device:
+    '''
+    Base for simulated I2C devices. A device that does not respond NACKs its
+    address like an unplugged part.
+        fault - None, 'nack' (never responds), 'stuck' (never finishes a
+            conversion) or 'corrupt' (random data on reads)
+        fail_rate - probability that any transaction is NACKed
+    '''
+
+    def __init__(self, address):
+        self.address = address
+        self.fault = None
+        self.fail_rate = 0.0
+
+    def responds(self):
+        if self.fault == 'nack':
+            return False
+        return self.fail_rate <= 0 or random.random() >= self.fail_rate
+
+    def write(self, data):
+        pass
+
+    def read(self, n):
+        return bytes(n)
+
+    def _corrupt(self, data):
+        if self.fault == 'corrupt':
+            return bytes(random.getrandbits(8) for _ in data)
+        return bytes(data)
+
+class RegisterDevice(Device):
+    '''
+    Device with an 8-bit register pointer set by the first byte of a write,
+    auto-incrementing on reads and writes.
+    '''
+
+    def __init__(self, address, size=256):
+        super().__init__(address)
+        self.regs = bytearray(size)
+        self.pointer = 0
+
+    def write(self, data):
+        if len(data) == 0:
+            return
+        self.pointer = data[0]
+        for b in data[1:]:
+            self.write_reg(self.pointer, b)
+            self.pointer = (self.pointer + 1) % len(self.regs)
+
+    def write_reg(self, reg, value):
+        self.regs[reg] = value
+
+    def read(self, n):
+        self.update()
+        data = bytearray(n)
+        for i in range(n):
+            data[i] = self.regs[self.pointer]
+            self.pointer = (self.pointer + 1) % len(self.regs)
+        return self._corrupt(data)
+
+    def update(self):
+        pass
+
+class I2CMux(Device):
+    '''
+    TCA9548A style 8 channel switch. Writing one byte sets the mask of
+    enabled downstream channels, each of which holds its own devices.
+    '''
+
+    def __init__(self, address=0x70):
+        super().__init__(address)
+        self.mask = 0
+        self.channels = [{} for _ in range(8)]
+        self.writes = 0
+
+    def attach(self, channel, device):
+        self.channels[channel][device.address] = device
+        return device
+
+    def write(self, data):
+        if len(data) > 0:
+            self.mask = data[-1]
+            self.writes += 1
+
+    def read(self, n):
+        return bytes([self.mask] * n)
+
+class AHT10(Device):
+    '''
+    AHT10 temperature/humidity sensor. A measurement takes conversion_ms,
+    during which the busy bit is set and the previous data is returned.
+    '''
+
+    def __init__(self, address=0x38, temperature=25.0, humidity=50.0, noise=0.05):
+        super().__init__(address)
+        self.temperature = temperature
+        self.humidity = humidity
+        self.noise = noise
+        self.conversion_ms = 75
+        self.calibrated = False
+        self.ready_at = 0
+        self.data = bytearray(6)
+        self.measurements = 0
+
+    def write(self, data):
+        if len(data) == 0:
+            return
+        if data[0] == 0xE1: # initialize
+            self.calibrated = (len(data) > 1 and data[1] & 0x08) != 0
+        elif data[0] == 0xAC: # trigger measurement
+            self.ready_at = _now() + self.conversion_ms / 1000 * random.uniform(0.95, 1.05)
+            self.measurements += 1
+            self._latched = False
+        elif data[0] == 0xBA: # soft reset
+            self.calibrated = False
+
+    def _latch(self):
+        t = self.temperature + random.gauss(0, self.noise)
+        h = min(max(self.humidity + random.gauss(0, self.noise), 0), 100)
+        raw_h = min(int(h / 100 * 2**20), 2**20 - 1)
+        raw_t = min(max(int((t + 50) / 200 * 2**20), 0), 2**20 - 1)
+        self.data[1] = raw_h >> 12
+        self.data[2] = (raw_h >> 4) & 0xFF
+        self.data[3] = ((raw_h & 0x0F) << 4) | (raw_t >> 16)
+        self.data[4] = (raw_t >> 8) & 0xFF
+        self.data[5] = raw_t & 0xFF
+
+    def read(self, n):
+        busy = self.fault == 'stuck' or _now() < self.ready_at
+        if not busy and not getattr(self, '_latched', True):
+            self._latch()
+            self._latched = True
+        self.data[0] = (0x80 if busy else 0) | (0x08 if self.calibrated else 0)
+        return self._corrupt(self.data[:n])
+
+class BMP180(RegisterDevice):
+    '''
+    BMP180 barometer with the datasheet example calibration EEPROM. Raw
+    results are derived by inverting the datasheet compensation, so the
+    driver recovers temperature (C) and pressure (Pa) from the registers.
+    '''
+    CALIBRATION = (408, -72, -14383, 32741, 32757, 23153, 6190, 4, -32768, -8711, 2868)
+    PRESSURE_MS = (4.5, 7.5, 13.5, 25.5)
+
+    def __init__(self, address=0x77, temperature=20.0, pressure=101325.0, noise=0.0):
+        super().__init__(address)
+        self.temperature = temperature
+        self.pressure = pressure
+        self.noise = noise
+        self.regs[0xD0] = 0x55 # chip id
+        self.regs[0xD1] = 0x02
+        struct.pack_into('>hhhHHHhhhhh', self.regs, 0xAA, *BMP180.CALIBRATION)
+        self.pending = None
+        self.ready_at = 0
+        self.conversions = 0
+
+    def write_reg(self, reg, value):
+        self.regs[reg] = value
+        if reg == 0xF4:
+            if value == 0x2E:
+                self.pending = ('T', 0)
+                delay = 4.5
+            elif value & 0x3F == 0x34:
+                oss = value >> 6
+                self.pending = ('P', oss)
+                delay = BMP180.PRESSURE_MS[oss]
+            else:
+                return
+            self.ready_at = _now() + delay / 1000
+            self.regs[0xF4] |= 0x20 # sco: conversion running
+            self.conversions += 1
+
+    def update(self):
+        if self.pending is None or self.fault == 'stuck' or _now() < self.ready_at:
+            return
+        kind,oss = self.pending
+        self.pending = None
+        self.regs[0xF4] &= ~0x20 & 0xFF
+        ut = self._invert(lambda ut: self.compensate(ut, 0, 0)[0], self.temperature * 10, 0, 0xFFFF)
+        if kind == 'T':
+            struct.pack_into('>H', self.regs, 0xF6, ut)
+        else:
+            p = self.pressure + random.gauss(0, self.noise)
+            up = self._invert(lambda up: self.compensate(ut, up, oss)[1], p, 0, (1 << (16 + oss)) - 1)
+            raw = up << (8 - oss)
+            self.regs[0xF6] = (raw >> 16) & 0xFF
+            self.regs[0xF7] = (raw >> 8) & 0xFF
+            self.regs[0xF8] = raw & 0xFF
+
+    def _invert(self, f, target, lo, hi):
+        while lo < hi: # f is increasing, find the first input reaching target
+            mid = (lo + hi) // 2
+            if f(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    @staticmethod
+    def compensate(ut, up, oss):
+        '''
+        Datasheet integer compensation, returns (0.1 C, Pa).
+        '''
+        AC1, AC2, AC3, AC4, AC5, AC6, B1, B2, MB, MC, MD = BMP180.CALIBRATION
+        div = lambda a, b: int(a / b) # C division truncates toward zero
+        X1 = (ut - AC6) * AC5 >> 15
+        X2 = div(MC << 11, X1 + MD)
+        B5 = X1 + X2
+        T = (B5 + 8) >> 4
+        B6 = B5 - 4000
+        X1 = (B2 * (B6 * B6 >> 12)) >> 11
+        X2 = AC2 * B6 >> 11
+        X3 = X1 + X2
+        B3 = div(((AC1 * 4 + X3) << oss) + 2, 4)
+        X1 = AC3 * B6 >> 13
+        X2 = (B1 * (B6 * B6 >> 12)) >> 16
+        X3 = ((X1 + X2) + 2) >> 2
+        B4 = (AC4 * ((X3 + 32768) & 0xFFFFFFFF)) >> 15
+        B7 = ((up - B3) * (50000 >> oss)) & 0xFFFFFFFF
+        if B7 < 0x80000000:
+            p = (B7 * 2) // B4
+        else:
+            p = (B7 // B4) * 2
+        X1 = (p >> 8) * (p >> 8)
+        X1 = (X1 * 3038) >> 16
+        X2 = (-7357 * p) >> 16
+        return T, p + ((X1 + X2 + 3791) >> 4)
+
+class VEML7700(Device):
+    '''
+    VEML7700 ambient light sensor with 16-bit little-endian registers. The
+    ALS count tracks lux at the configured gain and integration time and is
+    refreshed once per integration period. The response is compressed at
+    high illuminance as undone by the application note's correction
+    polynomial.
+    '''
+    GAINS = {0: 1, 1: 2, 2: 1/8, 3: 1/4}
+    TIMES = {0b1100: 25, 0b1000: 50, 0b0000: 100, 0b0001: 200, 0b0010: 400, 0b0011: 800}
+
+    def __init__(self, address=0x10, lux=500.0, noise=0.01):
+        super().__init__(address)
+        self.lux = lux
+        self.noise = noise
+        self.regs = [0] * 8
+        self.regs[0] = 0x0001 # shut down until configured
+        self.pointer = 0
+        self.configured_at = 0
+        self.count = 0
+        self.sampled_at = 0
+        self.conf_writes = 0
+
+    def gain(self):
+        return VEML7700.GAINS[(self.regs[0] >> 11) & 0x3]
+
+    def integration_ms(self):
+        return VEML7700.TIMES.get((self.regs[0] >> 6) & 0xF, 100)
+
+    def resolution(self):
+        '''
+        Lux per count at the current setting (datasheet: 0.0036 at x2, 800 ms).
+        '''
+        return 0.0036 * (800 / self.integration_ms()) * (2 / self.gain())
+
+    def write(self, data):
+        if len(data) == 0:
+            return
+        self.pointer = data[0]
+        if len(data) >= 3:
+            self.regs[self.pointer] = data[1] | (data[2] << 8)
+            if self.pointer == 0:
+                self.configured_at = _now()
+                self.sampled_at = _now()
+                self.conf_writes += 1
+
+    def read(self, n):
+        if self.pointer == 4:
+            self._integrate()
+            value = self.count
+        else:
+            value = self.regs[self.pointer]
+        return self._corrupt(bytes([value & 0xFF, value >> 8])[:n])
+
+    def _integrate(self):
+        if self.regs[0] & 1 or self.fault == 'stuck':
+            return
+        period = self.integration_ms() / 1000
+        now = _now()
+        if now - self.sampled_at >= period:
+            self.sampled_at = now - (now - self.sampled_at) % period
+            lux = max(self.lux * (1 + random.gauss(0, self.noise)), 0)
+            self.count = min(int(self.response(lux) / self.resolution()), 0xFFFF)
+
+    @staticmethod
+    def response(lux):
+        '''
+        Uncorrected lux the sensor reports for lux.
+        '''
+        correct = lambda x: (((6.0135e-13 * x - 9.3924e-9) * x + 8.1488e-5) * x + 1.0023) * x
+        lo, hi = 0.0, lux
+        for _ in range(50): # correct() is increasing and above x, bisect for its inverse
+            mid = (lo + hi) / 2
+            if correct(mid) < lux:
+                lo = mid
+            else:
+                hi = mid
+        return lo
+
+class Bus:
+    '''
+    Simulated I2C bus. Transactions are routed to devices on the bus and on
+    every enabled channel of any mux on it, so several devices sharing an
+    address (behind a mux) all see a write. Reads from several devices are
+    wired-AND like the real open-drain bus. Each transaction costs bus time
+    at the configured frequency plus a per-transaction overhead, spent as
+    real sleeps, and is counted.
+    '''
+
+    def __init__(self, name='i2c'):
+        self.name = name
+        self.devices = {}
+        self.realtime = True
+        self.reset_counters()
+        self._debt = 0.0
+
+    def attach(self, device):
+        self.devices[device.address] = device
+        return device
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.bytes = 0
+        self.busy_us = 0.0
+        self.by_address = {}
+
+    def _targets(self, devices, address, found):
+        for device in devices.values():
+            if device.address == address:
+                found.append(device)
+            if isinstance(device, I2CMux) and device.responds():
+                for channel in range(8):
+                    if device.mask & (1 << channel):
+                        self._targets(device.channels[channel], address, found)
+        return found
+
+    def targets(self, address):
+        return [device for device in self._targets(self.devices, address, []) if device.responds()]
+
+    def spend(self, address, nbytes, bit_us, overhead_us):
+        '''
+        Account for one transaction of nbytes (plus the address byte).
+        '''
+        cost = 9 * (nbytes + 1) * bit_us + overhead_us
+        self.transactions += 1
+        self.bytes += nbytes
+        self.busy_us += cost
+        self.by_address[address] = self.by_address.get(address, 0) + 1
+        if self.realtime:
+            self._debt += cost / 1000000
+            if self._debt >= 0.001: # sleeping is too coarse for single transactions
+                time.sleep(self._debt)
+                self._debt = 0.0
+
+# ---------------------------------------------------------------------------
+# GPIO and the HX711
+
+class PinState:
+    '''
+    Shared state of one GPIO, however many Pin objects refer to it.
+        source - callable giving the level of an input driven by a model
+        listeners - callables notified of every level written
+        handler - interrupt handler called with irq_pin on trigger edges
+    '''
+
+    def __init__(self, id):
+        self.id = id
+        self.level = 0
+        self.mode = None
+        self.source = None
+        self.listeners = []
+        self.handler = None
+        self.trigger = 0
+        self.irq_pin = None
+        self.seen = 0 # level last seen by the interrupt watcher
+
+    def get(self):
+        return self.source() if self.source is not None else self.level
+
+    def set(self, level):
+        level = 1 if level else 0
+        if level == self.level:
+            return
+        self.level = level
+        for listener in self.listeners:
+            listener(level)
+
+class HX711:
+    '''
+    HX711 24-bit ADC at the GPIO level. DOUT falls when a conversion is
+    ready, each PD_SCK pulse shifts out one bit MSB first, and 1-3 extra
+    pulses select the next gain. Holding PD_SCK high for more than 60 us
+    powers the chip down; after power up the first result takes settle
+    conversions. weight (kg) is converted to counts with the driver defaults.
+    '''
+
+    def __init__(self, board, clk, dat, weight=10.0, scale=0.00005, offset=245500, rate=10, noise=20):
+        self.weight = weight
+        self.scale = scale
+        self.offset = offset
+        self.rate = rate # samples per second, 10 or 80
+        self.noise = noise # counts
+        self.settle = 4 # conversions after power up
+        self.fault = None
+        self.powered = True
+        self.high_since = None
+        self.ready_at = _now() + self.settle / rate
+        self.bit = 0 # rising edges seen in the current readout
+        self.value = 0
+        self.conversions = 0
+        self.powerdowns = 0
+        self.clk = board.pin(clk)
+        self.dat = board.pin(dat)
+        self.clk.listeners.append(self._clock)
+        self.dat.source = self._dout
+
+    def raw(self):
+        count = int(self.weight / self.scale + self.offset + random.gauss(0, self.noise))
+        return count & 0xFFFFFF
+
+    def ready(self):
+        return self.powered and self.bit == 0 and self.fault != 'stuck' and _now() >= self.ready_at
+
+    def _dout(self):
+        if not self.powered:
+            return 1
+        if 0 < self.bit <= 24:
+            return (self.value >> (24 - self.bit)) & 1
+        return 0 if self.ready() else 1
+
+    def _clock(self, level):
+        now = _now()
+        if level:
+            self.high_since = now
+            if self.bit == 0 and self.ready():
+                self.value = self.raw() # latch a conversion and start the readout
+                self.conversions += 1
+            if self.bit > 0 or self.ready():
+                self.bit += 1
+            if self.bit >= 25:
+                self.bit = 0 # gain select pulse ends the readout
+                self.ready_at = now + 1 / self.rate
+        else:
+            if self.high_since is not None and now - self.high_since > 60e-6:
+                self.powered = True # waking up from power down
+                self.powerdowns += 1
+                self.bit = 0
+                self.ready_at = now + self.settle / self.rate
+            self.high_since = None
+
+    def poll(self):
+        '''
+        Power down once PD_SCK has been held high for more than 60 us.
+        '''
+        if self.high_since is not None and _now() - self.high_since > 60e-6:
+            self.powered = False
+
+# ---------------------------------------------------------------------------
+# Board
+
+class Board:
+    '''
+    The simulated hardware: GPIO states, I2C buses keyed by (scl, sda) pin
+    ids, SPI byte counters and the device models on them.
+    '''
+
+    def __init__(self):
+        self.pins = {}
+        self.buses = {}
+        self.spi_bytes = 0
+        self.spi_writes = 0
+        self.hx711s = []
+        self.watcher = None
+        self.irqs = 0
+
+    def pin(self, id):
+        if id not in self.pins:
+            self.pins[id] = PinState(id)
+        return self.pins[id]
+
+    def bus(self, scl, sda):
+        key = (scl, sda)
+        if key not in self.buses:
+            self.buses[key] = Bus(f'i2c{scl}/{sda}')
+        return self.buses[key]
+
+    def poll(self):
+        for hx in self.hx711s:
+            hx.poll()
+
+    def watch(self, interval=0.0005):
+        '''
+        Start the thread delivering pin interrupts, once. Levels are sampled
+        every interval seconds, and handlers run on that thread, preempting
+        the firmware between bytecodes much like MicroPython's scheduler.
+        '''
+        if self.watcher is None:
+            self.watcher = threading.Thread(target=self._watch, args=(interval,), daemon=True)
+            self.watcher.start()
+
+    def _watch(self, interval):
+        while True:
+            self.poll()
+            for state in list(self.pins.values()):
+                if state.handler is None:
+                    continue
+                level = state.get()
+                if level == state.seen:
+                    continue
+                state.seen = level
+                if state.trigger & (Pin.IRQ_RISING if level else Pin.IRQ_FALLING):
+                    self.irqs += 1
+                    try:
+                        state.handler(state.irq_pin)
+                    except Exception:
+                        print('Unhandled exception in IRQ callback handler')
+                        traceback.print_exc()
+            time.sleep(interval)
+
+    @staticmethod
+    def default(aht10=5, muxes=None):
+        '''
+        The board main.py expects: a mux at 0x70 with an AHT10 on each of the
+        first aht10 channels, a BMP180 and VEML7700 on the main bus and an
+        HX711 on pins (4, 36). The AHT10s are dealt round robin over muxes
+        at 0x70, 0x71... up to 0x76 (0x77 is the BMP180), by default as
+        few as hold them.
+        '''
+        if muxes is None:
+            muxes = max(1, (aht10 + 7) // 8)
+        assert muxes <= 7 and aht10 <= 8 * muxes, 'too many AHT10s for the muxes'
+        board = Board()
+        bus = board.bus(16, 13)
+        board.i2c = bus
+        board.muxes = [bus.attach(I2CMux(0x70 + m)) for m in range(muxes)]
+        board.mux = board.muxes[0]
+        board.ahts = [board.muxes[i % muxes].attach(i // muxes, AHT10(temperature=24.0 + i, humidity=55.0 + i))
+                      for i in range(aht10)]
+        board.bmp = bus.attach(BMP180())
+        board.veml = bus.attach(VEML7700())
+        board.hx711 = HX711(board, clk=4, dat=36)
+        board.hx711s.append(board.hx711)
+        return board
+
+# ---------------------------------------------------------------------------
+# machine
+
+def _pin_id(pin):
+    return pin.id if isinstance(pin, Pin) else pin
+
+class Pin:
+    IN = 1
+    OUT = 3
+    OPEN_DRAIN = 7
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 2
+    IRQ_RISING = 1
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.state = BOARD.pin(id)
+        self.init(mode, pull, value=value)
+
+    def init(self, mode=-1, pull=-1, value=None):
+        if mode != -1:
+            self.state.mode = mode
+        if value is not None:
+            self.state.set(value)
+
+    def value(self, level=None):
+        if level is None:
+            BOARD.poll()
+            return self.state.get()
+        self.state.set(level)
+
+    def __call__(self, level=None):
+        return self.value(level)
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        self.state.seen = self.state.get()
+        self.state.trigger = trigger
+        self.state.irq_pin = self
+        self.state.handler = handler
+        if handler is not None:
+            BOARD.watch()
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+
+class SoftI2C:
+    '''
+    Bit-banged I2C: GPIO toggling adds to every bit time.
+    '''
+    BIT_OVERHEAD_US = 2.0
+    TRANSACTION_US = 40.0
+
+    def __init__(self, scl, sda, freq=400000, timeout=50000):
+        self.bus = BOARD.bus(_pin_id(scl), _pin_id(sda))
+        self.init(scl, sda, freq)
+
+    def init(self, scl=None, sda=None, freq=400000, timeout=50000):
+        self.freq = freq
+
+    def _bit_us(self):
+        return 1000000 / self.freq + self.BIT_OVERHEAD_US
+
+    def _spend(self, address, nbytes):
+        self.bus.spend(address, nbytes, self._bit_us(), self.TRANSACTION_US)
+
+    def _target(self, address):
+        found = self.bus.targets(address)
+        if len(found) == 0:
+            self._spend(address, 0)
+            raise OSError(19, 'ENODEV') # address NACK
+        return found
+
+    def scan(self):
+        return [address for address in range(0x08, 0x78) if len(self.bus.targets(address)) > 0]
+
+    def writeto(self, addr, buf, stop=True):
+        for device in self._target(addr):
+            device.write(bytes(buf))
+        self._spend(addr, len(buf))
+        return len(buf)
+
+    def readfrom(self, addr, nbytes, stop=True):
+        data = None
+        for device in self._target(addr):
+            chunk = device.read(nbytes)
+            data = chunk if data is None else bytes(a & b for a,b in zip(data, chunk))
+        self._spend(addr, nbytes)
+        return data
+
+    def readfrom_into(self, addr, buf, stop=True):
+        buf[:] = self.readfrom(addr, len(buf))
+
+    def writeto_mem(self, addr, memaddr, buf, addrsize=8):
+        for device in self._target(addr):
+            device.write(bytes([memaddr]) + bytes(buf))
+        self._spend(addr, 1 + len(buf))
+
+    def readfrom_mem(self, addr, memaddr, nbytes, addrsize=8):
+        data = None
+        for device in self._target(addr):
+            device.write(bytes([memaddr]))
+            chunk = device.read(nbytes)
+            data = chunk if data is None else bytes(a & b for a,b in zip(data, chunk))
+        self._spend(addr, 1) # register pointer write, then a repeated start read
+        self._spend(addr, nbytes)
+        return data
+
+    def readfrom_mem_into(self, addr, memaddr, buf, addrsize=8):
+        buf[:] = self.readfrom_mem(addr, memaddr, len(buf))
+
+class I2C(SoftI2C):
+    '''
+    Hardware I2C peripheral: exact bit timing, but each transaction pays for
+    building and running an ESP-IDF command link. Like on the ESP32,
+    constructing an id again reconfigures and returns the same object.
+    '''
+    BIT_OVERHEAD_US = 0.0
+    TRANSACTION_US = 25.0
+    _peripherals = {}
+
+    def __new__(cls, id=0, *args, **kwargs):
+        if id not in I2C._peripherals:
+            I2C._peripherals[id] = super().__new__(cls)
+        return I2C._peripherals[id]
+
+    def __init__(self, id=0, scl=None, sda=None, freq=400000, timeout=50000):
+        super().__init__(scl, sda, freq)
+        self.id = id
+
+class SoftSPI:
+
+    def __init__(self, baudrate=500000, polarity=0, phase=0, bits=8, firstbit=0, sck=None, mosi=None, miso=None):
+        self.baudrate = baudrate
+
+    def init(self, baudrate=None, **kwargs):
+        if baudrate is not None:
+            self.baudrate = baudrate
+
+    def deinit(self):
+        pass
+
+    def write(self, buf):
+        BOARD.spi_writes += 1
+        BOARD.spi_bytes += len(buf)
+        time.sleep(len(buf) * 8 / self.baudrate)
+
+    def read(self, nbytes, write=0x00):
+        self.write(bytes(nbytes))
+        return bytes(nbytes)
+
+    def readinto(self, buf, write=0x00):
+        self.write(buf)
+
+    def write_readinto(self, write_buf, read_buf):
+        self.write(write_buf)
+
+class SPI(SoftSPI):
+
+    def __init__(self, id=1, baudrate=500000, **kwargs):
+        super().__init__(baudrate, **kwargs)
+        self.id = id
+
+def reset():
+    print('machine.reset()')
+    raise SystemExit(0)
+
+def freq(hz=None):
+    return 240000000
+
+def unique_id():
+    return b'\xbe\xe1\x09\x9e\xe0\x01'
+
+# ---------------------------------------------------------------------------
+# framebuf (RGB565 only; text uses placeholder glyphs, not the real font)
+
+class FrameBuffer:
+
+    def __init__(self, buf, width, height, format, stride=None):
+        self.buf = buf
+        self.width = width
+        self.height = height
+
+    def pixel(self, x, y, c=None):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        i = 2 * (y * self.width + x)
+        if c is None:
+            return self.buf[i] | (self.buf[i + 1] << 8)
+        self.buf[i] = c & 0xFF
+        self.buf[i + 1] = (c >> 8) & 0xFF
+
+    def fill_rect(self, x, y, w, h, c):
+        for yy in range(max(y, 0), min(y + h, self.height)):
+            for xx in range(max(x, 0), min(x + w, self.width)):
+                self.pixel(xx, yy, c)
+
+    def fill(self, c):
+        self.fill_rect(0, 0, self.width, self.height, c)
+
+    def hline(self, x, y, w, c):
+        self.fill_rect(x, y, w, 1, c)
+
+    def vline(self, x, y, h, c):
+        self.fill_rect(x, y, 1, h, c)
+
+    def rect(self, x, y, w, h, c, f=False):
+        if f:
+            return self.fill_rect(x, y, w, h, c)
+        self.hline(x, y, w, c)
+        self.hline(x, y + h - 1, w, c)
+        self.vline(x, y, h, c)
+        self.vline(x + w - 1, y, h, c)
+
+    def text(self, s, x, y, c=1):
+        for k,ch in enumerate(s):
+            if ch == ' ':
+                continue
+            bits = (ord(ch) * 2654435761) & 0xFFFFFFFFFFFF
+            for row in range(8):
+                for col in range(8):
+                    if (bits >> ((row * 8 + col) % 48)) & 1:
+                        self.pixel(x + 8 * k + col, y + row, c)
+
+# ---------------------------------------------------------------------------
+# network and webrepl
+
+class LAN:
+
+    def __init__(self, *args, **kwargs):
+        self._active = False
+
+    def active(self, state=None):
+        if state is None:
+            return self._active
+        self._active = bool(state)
+        return self._active
+
+    def ifconfig(self, config=None):
+        return ('127.0.0.1', '255.0.0.0', '127.0.0.1', '8.8.8.8')
+
+    def isconnected(self):
+        return self._active
+
+# ---------------------------------------------------------------------------
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    for key,value in attrs.items():
+        setattr(module, key, value)
+    sys.modules[name] = module
+    return module
+
+def install(board=None):
+    '''
+    Register the simulated MicroPython modules so firmware imports resolve to
+    them. Returns the Board, by default Board.default().
+    '''
+    global BOARD
+    BOARD = Board.default() if board is None else board
+    for name,f in (('ticks_ms', ticks_ms), ('ticks_us', ticks_us), ('ticks_cpu', ticks_us),
+                   ('ticks_diff', ticks_diff), ('ticks_add', ticks_add),
+                   ('sleep_ms', sleep_ms), ('sleep_us', sleep_us)):
+        setattr(time, name, f)
+    _module('machine', Pin=Pin, SoftI2C=SoftI2C, I2C=I2C, SoftSPI=SoftSPI, SPI=SPI,
+            reset=reset, freq=freq, unique_id=unique_id)
+    _module('micropython', const=lambda x: x, schedule=lambda f, arg: f(arg),
+            native=lambda f: f, viper=lambda f: f, alloc_emergency_exception_buf=lambda n: None)
+    _module('framebuf', FrameBuffer=FrameBuffer, RGB565=1, MONO_HLSB=3, MONO_VLSB=0)
+    _module('network', LAN=LAN, WLAN=LAN, PHY_LAN8720=0, STA_IF=0, AP_IF=1)
+    _module('webrepl', start=lambda *args, **kwargs: None)
+    sys.modules['ustruct'] = struct
+    sys.modules['uasyncio'] = asyncio
+    return BOARD
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    flash = args[args.index('--flash') + 1] if '--flash' in args else 'flash'
+    os.makedirs(flash, exist_ok=True)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    install()
+    os.chdir(flash) # the firmware's relative paths land in the simulated flash
+    runpy.run_module('main', run_name='__main__')
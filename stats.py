@@ -0,0 +1,177 @@
+from array import array
+import time
+
+class Stats:
+
+    def __init__(self, names=()):
+        '''
+        Call count, failures, cumulative/max/last duration and last error for
+        a set of named operations. Counters are kept in arrays sized when a
+        name is added, so record() does not allocate. Durations are in us;
+        the cumulative time is split into ms and a us remainder so it stays
+        a small int for ~12 days of busy time.
+        '''
+        self.names = []
+        self.index = {}
+        self.count = array('I')
+        self.failures = array('I')
+        self.total_ms = array('I')
+        self.total_us = array('I')
+        self.max_us = array('I')
+        self.last_us = array('I')
+        self.errors = [] # last exception per name
+        self.error_ticks = array('I') # ticks_ms of the last error
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        '''
+        Returns the slot of name, adding it if new.
+        '''
+        if name in self.index:
+            return self.index[name]
+        self.index[name] = len(self.names)
+        self.names.append(name)
+        for counter in (self.count, self.failures, self.total_ms, self.total_us, self.max_us, self.last_us, self.error_ticks):
+            counter.append(0)
+        self.errors.append(None)
+        return self.index[name]
+
+    def record(self, name, start, error=None):
+        '''
+        Account for one call of name that began at ticks_us() start, and
+        failed with error if given.
+        '''
+        self.record_slot(self.index[name], start, error)
+
+    def record_slot(self, i, start, error=None):
+        elapsed = time.ticks_diff(time.ticks_us(), start)
+        self.count[i] += 1
+        us = self.total_us[i] + elapsed
+        self.total_ms[i] += us // 1000
+        self.total_us[i] = us % 1000
+        self.last_us[i] = elapsed
+        if elapsed > self.max_us[i]:
+            self.max_us[i] = elapsed
+        if error is not None:
+            self.failures[i] += 1
+            self.errors[i] = error
+            self.error_ticks[i] = time.ticks_ms()
+
+    def seconds(self, i):
+        '''
+        Cumulative duration of slot i in seconds.
+        '''
+        return self.total_ms[i] / 1000 + self.total_us[i] / 1000000
+
+    def reset(self):
+        for counter in (self.count, self.failures, self.total_ms, self.total_us, self.max_us, self.last_us, self.error_ticks):
+            for i in range(len(counter)):
+                counter[i] = 0
+        for i in range(len(self.errors)):
+            self.errors[i] = None
+
+    def report(self):
+        '''
+        Returns {name: {count, failures, total_ms, max_ms, last_ms, last_error, error_age}}
+        with the age of the last error in seconds.
+        '''
+        now = time.ticks_ms()
+        report = {}
+        for i,name in enumerate(self.names):
+            error = self.errors[i]
+            report[name] = {
+                'count': self.count[i],
+                'failures': self.failures[i],
+                'total_ms': self.seconds(i) * 1000,
+                'max_ms': self.max_us[i] / 1000,
+                'last_ms': self.last_us[i] / 1000,
+                'last_error': None if error is None else f'{type(error).__name__}: {error}',
+                'error_age': None if error is None else time.ticks_diff(now, self.error_ticks[i]) / 1000,
+            }
+        return report
+
+class StatsI2C:
+
+    def __init__(self, i2c, stats, prefix='i2c'):
+        '''
+        Wraps an I2C or SoftI2C object, recording every transaction in stats
+        under '{prefix}_0x{address:02x}'. Errors are recorded and re-raised.
+        '''
+        self.i2c = i2c
+        self.stats = stats
+        self.prefix = prefix
+        self._slots = array('h', (-1 for _ in range(128))) # stats slot by 7 bit address
+
+    def _slot(self, addr):
+        slot = self._slots[addr]
+        if slot < 0:
+            slot = self.stats.add(f'{self.prefix}_0x{addr:02x}')
+            self._slots[addr] = slot
+        return slot
+
+    def scan(self):
+        return self.i2c.scan()
+
+    def writeto(self, addr, buf, stop=True):
+        slot = self._slot(addr)
+        start = time.ticks_us()
+        try:
+            result = self.i2c.writeto(addr, buf, stop)
+        except Exception as e:
+            self.stats.record_slot(slot, start, e)
+            raise
+        self.stats.record_slot(slot, start)
+        return result
+
+    def readfrom(self, addr, nbytes, stop=True):
+        slot = self._slot(addr)
+        start = time.ticks_us()
+        try:
+            result = self.i2c.readfrom(addr, nbytes, stop)
+        except Exception as e:
+            self.stats.record_slot(slot, start, e)
+            raise
+        self.stats.record_slot(slot, start)
+        return result
+
+    def readfrom_into(self, addr, buf, stop=True):
+        slot = self._slot(addr)
+        start = time.ticks_us()
+        try:
+            self.i2c.readfrom_into(addr, buf, stop)
+        except Exception as e:
+            self.stats.record_slot(slot, start, e)
+            raise
+        self.stats.record_slot(slot, start)
+
+    def writeto_mem(self, addr, memaddr, buf, addrsize=8):
+        slot = self._slot(addr)
+        start = time.ticks_us()
+        try:
+            self.i2c.writeto_mem(addr, memaddr, buf, addrsize=addrsize)
+        except Exception as e:
+            self.stats.record_slot(slot, start, e)
+            raise
+        self.stats.record_slot(slot, start)
+
+    def readfrom_mem(self, addr, memaddr, nbytes, addrsize=8):
+        slot = self._slot(addr)
+        start = time.ticks_us()
+        try:
+            result = self.i2c.readfrom_mem(addr, memaddr, nbytes, addrsize=addrsize)
+        except Exception as e:
+            self.stats.record_slot(slot, start, e)
+            raise
+        self.stats.record_slot(slot, start)
+        return result
+
+    def readfrom_mem_into(self, addr, memaddr, buf, addrsize=8):
+        slot = self._slot(addr)
+        start = time.ticks_us()
+        try:
+            self.i2c.readfrom_mem_into(addr, memaddr, buf, addrsize=addrsize)
+        except Exception as e:
+            self.stats.record_slot(slot, start, e)
+            raise
+        self.stats.record_slot(slot, start)
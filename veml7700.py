@@ -14,10 +14,10 @@ class VEML7700:
     # settings for [int_time_ms][gain]
     GAIN_VALS = {  25: {1/8: 1.8432, 1/4: 0.9216, 1: 0.2304, 2: 0.1152}, #25
                    50: {1/8: 0.9216, 1/4: 0.4608, 1: 0.1152, 2: 0.0576}, #50
-                   100:{1/8: 0.4608, 1/4: 0.2304, 1: 0.0288, 2: 0.0144}, #100
+                   100:{1/8: 0.4608, 1/4: 0.2304, 1: 0.0576, 2: 0.0288}, #100
                    200:{1/8: 0.2304, 1/4: 0.1152, 1: 0.0288, 2: 0.0144}, #200
                    400:{1/8: 0.1152, 1/4: 0.0576, 1: 0.0144, 2: 0.0072}, #400
-                   800:{1/8: 0.0876, 1/4: 0.0288, 1: 0.0072, 2: 0.0036}} #800
+                   800:{1/8: 0.0576, 1/4: 0.0288, 1: 0.0072, 2: 0.0036}} #800
     
     # Write registers
     ALS_CONF_0 = 0x00
@@ -29,14 +29,33 @@ class VEML7700:
     ALS = 0x04
     WHITE = 0x05
     INTERRUPT = 0x06
+    
+    # auto-ranging: counts below COUNT_LOW are too coarse, above COUNT_HIGH
+    # close to saturating; a new range is picked to land near COUNT_TARGET
+    COUNT_LOW = 100
+    COUNT_TARGET = 20000
+    COUNT_HIGH = 50000
+    TIMES = (25, 50, 100, 200, 400, 800)
+    GAINS = (2, 1, 1/4, 1/8)
 
     def __init__(self, i2c, address=0x10):
        
         self.address = address
         self.i2c = i2c
         self.raw_lux = bytearray([0,0])
+        self.auto = False
+        self.range = None # active (int_time_ms, gain)
+        self.conf_writes = 0
+        self._lux = None # last reading
+        self._valid_at = time.ticks_ms() # when the ALS count reflects the active range
 
-    def config(self, int_time_ms=25, gain=1/8):
+    def config(self, int_time_ms=25, gain=1/8, auto=False):
+        '''
+        Configure the integration time and gain. With auto they are only the
+        starting range: lux() then moves to the shortest integration time
+        (at the highest gain) that gives adequate counts whenever a reading
+        is too coarse or close to saturating, or a faster range would do.
+        '''
 
         _conf = VEML7700.ALS_CONF_VALS.get(int_time_ms)
         _gain = VEML7700.GAIN_VALS.get(int_time_ms)
@@ -46,12 +65,17 @@ class VEML7700:
             if _conf is not None and _gain is not None:
                 self._conf = _conf
                 self._gain = _gain
+                self.range = (int_time_ms, gain)
+                self.auto = auto
             else:
                 raise ValueError('gain must be one of 1/8, 1/4, 1, or 2')
         else:
             raise ValueError('int_time_ms 25, 50, 100, 200, 400, or 800')
        
         self.i2c.writeto_mem(self.address, VEML7700.ALS_CONF_0, self._conf )
+        self.conf_writes += 1
+        self._valid_at = time.ticks_add(time.ticks_ms(), int_time_ms * 11 // 10 + 5)
+        self._lux = None # from before (re)configuring, lux() must not serve it
         
         defaults = bytearray([0x00, 0x00])
         self.i2c.writeto_mem(self.address, VEML7700.ALS_WH, defaults)
@@ -59,10 +83,74 @@ class VEML7700:
         self.i2c.writeto_mem(self.address, VEML7700.POW_SAV, defaults)
         
         #time.sleep_ms(40)
+    
+    def set_range(self, int_time_ms, gain):
+        '''
+        Switch integration time and gain, writing ALS_CONF_0 only if they
+        change. The ALS count keeps the old range until an integration
+        period at the new one has passed.
+        '''
+        if self.range == (int_time_ms, gain):
+            return
+        self._conf = VEML7700.ALS_CONF_VALS[int_time_ms][gain]
+        self._gain = VEML7700.GAIN_VALS[int_time_ms][gain]
+        self.range = (int_time_ms, gain)
+        self.i2c.writeto_mem(self.address, VEML7700.ALS_CONF_0, self._conf)
+        self.conf_writes += 1
+        self._valid_at = time.ticks_add(time.ticks_ms(), int_time_ms * 11 // 10 + 5)
+    
+    def pick_range(self, lux):
+        '''
+        The shortest integration time, with the highest gain at it, whose
+        expected count for lux is at least COUNT_LOW without passing
+        COUNT_TARGET. Returns (int_time_ms, gain).
+        '''
+        for int_time_ms in VEML7700.TIMES:
+            for gain in VEML7700.GAINS:
+                count = lux / VEML7700.GAIN_VALS[int_time_ms][gain]
+                if count <= VEML7700.COUNT_TARGET:
+                    break
+            if count >= VEML7700.COUNT_LOW:
+                break
+        return int_time_ms, gain
         
     def _measure(self):
         self.raw_lux = self.i2c.readfrom_mem(self.address, VEML7700.ALS, 2)
         
+    def wait_ms(self):
+        '''
+        How long lux() would block: until the first integration completes.
+        '''
+        if self._lux is not None:
+            return 0
+        return max(time.ticks_diff(self._valid_at, time.ticks_ms()), 0)
+    
     def lux(self, read=True):
-        if read: self._measure()
-        return (self.raw_lux[0]+self.raw_lux[1]<<8)*self._gain
\ No newline at end of file
+        '''
+        Ambient light in lux, corrected for the sensor's non-linearity at
+        high illuminance. When auto-ranging, a read right after a range
+        change returns the previous reading instead of waiting for the
+        integration period (the first reading always waits).
+        '''
+        if read:
+            wait = time.ticks_diff(self._valid_at, time.ticks_ms())
+            if wait > 0:
+                if self._lux is not None:
+                    return self._lux
+                time.sleep_ms(wait)
+            self._measure()
+        count = self.raw_lux[0] | (self.raw_lux[1] << 8)
+        lux = count*self._gain
+        # application note polynomial correction
+        lux = (((6.0135e-13*lux - 9.3924e-9)*lux + 8.1488e-5)*lux + 1.0023)*lux
+        if read:
+            self._lux = lux
+            if self.auto:
+                if count < VEML7700.COUNT_LOW or count > VEML7700.COUNT_HIGH:
+                    self.set_range(*self.pick_range(lux))
+                else:
+                    # move to a shorter time or higher gain only with 2x margin, so it does not hunt
+                    int_time_ms, gain = self.pick_range(lux / 2)
+                    if int_time_ms < self.range[0] or (int_time_ms == self.range[0] and gain > self.range[1]):
+                        self.set_range(int_time_ms, gain)
+        return lux
\ No newline at end of file